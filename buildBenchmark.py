@@ -0,0 +1,268 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import geohash as geohasher
+import numpy
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from geohashTable import encode
+
+# Benchmarks the KmlBuilder end to end, without a real POI dump. The POI are
+# synthetic ppids - {cc:3}{gh:5}-{uuid:32} - with the skew of the real thing:
+# a few countries have most of the POI, and within a country most are in its
+# cities (a few big ones, and a long tail of smaller ones), the rest being
+# spread thinly over the country. So the densest 5-digit geohashs have
+# thousands of POI, and most have a handful. The ppid files are generated once,
+# a chunk at a time, and kept for the runs that follow.
+# Each build mode is then run on them - as kml-builder.py itself, in a process
+# of its own, so that each run's peak RSS is its own - with --profile, and the
+# throughput and memory of the whole run and of each of its stages (see
+# stageProfiler.py) are reported. A report from an earlier run can be given as
+# a baseline, to catch regressions: any stage (of more than a second) that has
+# got slower, or run that has got bigger, by more than the tolerance.
+#
+# Usage: python buildBenchmark.py [--scale 10K|1M|10M|N] [--modes directory,...]
+#   [--workers N] [--dir DIR] [--report FILE] [--baseline FILE]
+
+SCALES = {"10K": 10000, "1M": 1000000, "10M": 10000000}
+
+# The (country code, latitude, longitude, spread in degrees, weight) of the
+# countries of the POI - the weights being their shares of them
+COUNTRIES = [
+  ("840", 39.8, -98.6, 10.0, 30),
+  ("156", 35.0, 105.0, 8.0, 12),
+  ("356", 22.0, 79.0, 6.0, 8),
+  ("276", 51.0, 10.0, 2.5, 7),
+  ("826", 53.0, -1.5, 2.0, 6),
+  ("250", 46.5, 2.5, 2.5, 6),
+  ("392", 36.0, 138.0, 3.0, 6),
+  ("076", -12.0, -50.0, 8.0, 5),
+  ("724", 40.0, -3.7, 2.5, 4),
+  ("380", 42.8, 12.5, 2.5, 4),
+  ("124", 50.0, -95.0, 10.0, 3),
+  ("036", -25.0, 134.0, 9.0, 3),
+  ("484", 23.0, -102.0, 5.0, 3),
+  ("643", 56.0, 50.0, 10.0, 3),
+  ("528", 52.2, 5.3, 0.7, 2),
+  ("246", 62.0, 26.0, 2.5, 1),
+  ("710", -29.0, 25.0, 4.0, 1),
+  ("566", 9.0, 8.0, 3.0, 1),
+]
+CITIES_PER_COUNTRY = 50
+# The share of the POI that are in cities, rather than spread over the country
+CITY_SHARE = 0.7
+CHUNK_SIZE = 1000000
+
+HEX = "0123456789abcdef"
+
+# The command line options of each of the build modes; the spill files go in
+# the run's directory
+MODES = {
+  "directory": [],
+  "in-memory": ["--in-memory"],
+  "compact": ["--compact"],
+  "spill": ["--spill", "."],
+}
+
+# Only stages that took at least this long are checked against a baseline -
+# the throughput of shorter ones is mostly noise
+MIN_STAGE_SECONDS = 1.0
+
+def cities(random):
+  """ returns the (country, latitude, longitude, spread, weight) arrays of the
+    cities of every country - a city's weight being its share of its country's
+    city POI, which falls off with its rank, as city sizes do """
+  (country, lat, lng, spread, weight) = ([], [], [], [], [])
+  ranks = numpy.arange(1, CITIES_PER_COUNTRY + 1)
+  for (i, (countryCode, countryLat, countryLng, countrySpread, countryWeight)) \
+      in enumerate(COUNTRIES):
+    country.append(numpy.repeat(i, CITIES_PER_COUNTRY))
+    lat.append(random.normal(countryLat, countrySpread / 2, CITIES_PER_COUNTRY))
+    lng.append(random.normal(countryLng, countrySpread / 2, CITIES_PER_COUNTRY))
+    # The biggest cities sprawl the most
+    spread.append(0.15 / numpy.sqrt(ranks))
+    weight.append(countryWeight * CITY_SHARE * (1.0 / ranks) / (1.0 / ranks).sum())
+  return tuple(numpy.concatenate(a) for a in (country, lat, lng, spread, weight))
+
+def generatePpids(chunk, random, cityTable):
+  """ returns the lines of a chunk of chunk synthetic ppids, as one string """
+  weights = numpy.array([c[4] for c in COUNTRIES], dtype=numpy.float64)
+  (cityCountry, cityLat, cityLng, citySpread, cityWeight) = cityTable
+  # Each POI is either in a city, or spread over the country: the first
+  # len(cityWeight) choices are the cities, the rest the countries
+  choices = numpy.concatenate((cityWeight, weights * (1 - CITY_SHARE)))
+  choice = random.choice(len(choices), chunk, p=choices / choices.sum())
+  inCity = choice < len(cityWeight)
+  cityChoice = numpy.minimum(choice, len(cityWeight) - 1)
+  country = numpy.where(inCity, cityCountry[cityChoice], choice - len(cityWeight))
+  centreLat = numpy.array([c[1] for c in COUNTRIES])[country]
+  centreLng = numpy.array([c[2] for c in COUNTRIES])[country]
+  spread = numpy.array([c[3] for c in COUNTRIES])[country]
+  centreLat = numpy.where(inCity, cityLat[cityChoice], centreLat)
+  centreLng = numpy.where(inCity, cityLng[cityChoice], centreLng)
+  spread = numpy.where(inCity, citySpread[cityChoice], spread)
+  lat = numpy.clip(random.normal(centreLat, spread), -89.99, 89.99)
+  lng = (random.normal(centreLng, spread) + 180.0) % 360.0 - 180.0
+
+  chars = numpy.empty((chunk, 42), dtype=numpy.uint8)
+  countryCodes = numpy.array([[ord(c) for c in cc[0]] for cc in COUNTRIES], \
+      dtype=numpy.uint8)
+  chars[:, 0:3] = countryCodes[country]
+  chars[:, 3:8] = encode(lat, lng, 5)
+  chars[:, 8] = ord("-")
+  hexDigits = numpy.frombuffer(HEX, dtype=numpy.uint8)
+  chars[:, 9:41] = hexDigits[random.randint(0, 16, (chunk, 32))]
+  chars[:, 41] = ord("\n")
+  return chars.tostring()
+
+def checkEncode(random):
+  """ checks encode against geohash.encode """
+  lat = random.uniform(-90, 90, 1000)
+  lng = random.uniform(-180, 180, 1000)
+  chars = encode(lat, lng, 5)
+  for i in range(len(lat)):
+    expected = geohasher.encode(lat[i], lng[i], 5)
+    if chars[i].tostring() != expected:
+      raise AssertionError("encode and geohash.encode disagree for %f,%f: %s, %s" \
+          % (lat[i], lng[i], chars[i].tostring(), expected))
+
+def ppidFile(dirname, numPoi, seed=1):
+  """ returns the synthetic ppid file of numPoi POI in dirname, generating it
+    first if need be """
+  filename = os.path.join(dirname, "ppids-%d-%d.txt" % (numPoi, seed))
+  if os.path.exists(filename):
+    return filename
+  random = numpy.random.RandomState(seed)
+  checkEncode(random)
+  cityTable = cities(random)
+  start = time.time()
+  f = open(filename + ".tmp", "wb")
+  for offset in range(0, numPoi, CHUNK_SIZE):
+    f.write(generatePpids(min(CHUNK_SIZE, numPoi - offset), random, cityTable))
+  f.close()
+  os.rename(filename + ".tmp", filename)
+  print "Generated %d ppids in %.2fs" % (numPoi, time.time() - start)
+  return filename
+
+def run(mode, poiFile, numPoi, dirname, workers=1):
+  """ runs a build of the mode in a directory of its own under dirname,
+    returning its report """
+  here = os.path.dirname(os.path.abspath(__file__))
+  runDir = tempfile.mkdtemp(prefix="%s-" % mode, dir=dirname)
+  command = [sys.executable, os.path.join(here, "kml-builder.py"), \
+      os.path.abspath(poiFile), "--workers", str(workers), \
+      "--profile", "profile.json"] + MODES[mode]
+  log = open(os.path.join(runDir, "build.log"), "w")
+  start = time.time()
+  status = subprocess.call(command, cwd=runDir, stdout=log, stderr=subprocess.STDOUT)
+  wallSeconds = time.time() - start
+  log.close()
+  if status != 0:
+    raise RuntimeError("%s build failed, see %s/build.log" % (mode, runDir))
+  profile = json.load(open(os.path.join(runDir, "profile.json")))
+  shutil.rmtree(runDir)
+  stages = dict()
+  for stage in profile["stages"]:
+    stages[stage["name"]] = dict((key, stage[key]) for key in \
+        ("wallSeconds", "cpuSeconds", "peakRssMB", "items", "files", "itemsPerSecond"))
+  return dict(mode=mode, numPoi=numPoi, workers=workers, \
+      wallSeconds=round(wallSeconds, 3), cpuSeconds=profile["cpuSeconds"], \
+      peakRssMB=profile["peakRssMB"], \
+      poiPerSecond=round(numPoi / wallSeconds, 1), stages=stages)
+
+def regressions(runs, baselineRuns, tolerance):
+  """ returns the descriptions of where the runs have got slower, or bigger,
+    than the baseline's runs of the same mode, scale and workers """
+  baseline = dict()
+  for r in baselineRuns:
+    baseline[(r["mode"], r["numPoi"], r["workers"])] = r
+  found = []
+  for r in runs:
+    b = baseline.get((r["mode"], r["numPoi"], r["workers"]))
+    if b is None:
+      continue
+    name = "%s (%d POI)" % (r["mode"], r["numPoi"])
+    if r["peakRssMB"] > b["peakRssMB"] * (1 + tolerance):
+      found.append("%s peak RSS %.1fMB, was %.1fMB" % (name, r["peakRssMB"], \
+          b["peakRssMB"]))
+    for (stageName, stage) in sorted(r["stages"].iteritems()):
+      was = b["stages"].get(stageName)
+      if was is None or max(stage["wallSeconds"], was["wallSeconds"]) < MIN_STAGE_SECONDS:
+        continue
+      if stage["itemsPerSecond"] < was["itemsPerSecond"] * (1 - tolerance):
+        found.append("%s %s %.1f items/s, was %.1f" % (name, stageName, \
+            stage["itemsPerSecond"], was["itemsPerSecond"]))
+  return found
+
+def printRun(r):
+  print "%s: %d POI in %.2fs (%.1f POI/s, %.2fs CPU), peak RSS %.1fMB" % \
+      (r["mode"], r["numPoi"], r["wallSeconds"], r["poiPerSecond"], \
+      r["cpuSeconds"], r["peakRssMB"])
+  for (stageName, stage) in sorted(r["stages"].iteritems(), \
+      key=lambda (stageName, stage): -stage["wallSeconds"]):
+    print "  %-12s %8.2fs %12.1f items/s %8d files %8.1fMB" % (stageName, \
+        stage["wallSeconds"], stage["itemsPerSecond"], stage["files"], \
+        stage["peakRssMB"])
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description="Benchmarks the KmlBuilder's build modes on synthetic ppids")
+  parser.add_argument("--scale", default="10K", metavar="SCALE",
+      help="the number of POI: 10K, 1M, 10M or any number (default 10K)")
+  parser.add_argument("--modes", default="directory,in-memory,compact,spill",
+      help="the comma-separated build modes to run, of %s (note that the "
+      "directory build makes a file per POI)" % ", ".join(sorted(MODES)))
+  parser.add_argument("--workers", type=int, default=1, metavar="N")
+  parser.add_argument("--dir", metavar="DIR",
+      help="generate (and keep) the ppid files, and build, in DIR rather than "
+      "in a temporary directory")
+  parser.add_argument("--report", metavar="FILE",
+      help="write the report of the runs to FILE as JSON")
+  parser.add_argument("--baseline", metavar="FILE",
+      help="compare the runs with those of an earlier --report, exiting with 1 "
+      "on any regression")
+  parser.add_argument("--tolerance", type=float, default=0.2,
+      help="the fraction by which a stage's throughput may fall, or a run's "
+      "peak RSS grow, before it's a regression (default 0.2)")
+  args = parser.parse_args()
+  numPoi = SCALES.get(args.scale.upper())
+  if numPoi is None:
+    numPoi = int(args.scale)
+  modes = args.modes.split(",")
+  for mode in modes:
+    if mode not in MODES:
+      parser.error("unknown mode %s" % mode)
+  dirname = args.dir
+  if dirname is None:
+    dirname = tempfile.mkdtemp(prefix="benchmark-")
+  elif not os.path.isdir(dirname):
+    os.makedirs(dirname)
+  try:
+    poiFile = ppidFile(dirname, numPoi)
+    runs = []
+    for mode in modes:
+      runs.append(run(mode, poiFile, numPoi, dirname, args.workers))
+      printRun(runs[-1])
+  finally:
+    if args.dir is None:
+      shutil.rmtree(dirname)
+  if args.report is not None:
+    f = open(args.report, "w")
+    json.dump(dict(runs=runs), f, indent=2, sort_keys=True)
+    f.write("\n")
+    f.close()
+  if args.baseline is not None:
+    found = regressions(runs, json.load(open(args.baseline))["runs"], args.tolerance)
+    for regression in found:
+      print "REGRESSION: %s" % regression
+    if found:
+      sys.exit(1)
+  sys.exit(0)
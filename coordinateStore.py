@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import numpy
+
+from inputStream import InputStream
+
+# The coordinates and names of the POI, from a bulk file of
+#   {ppid},{lat},{lng},{name}
+# lines (the name may itself have commas in it) rather than from one call per
+# POI to the places API. With tens of millions of POI a dict of tuples would be
+# far too big, so the store is a set of numpy arrays sorted by ppid: the ppids
+# as fixed-width strings, float32 coordinates and all of the names in one
+# string, found by their offsets. That's ~60 bytes per POI plus the name, and
+# looking up all of the POI of a cell is one searchsorted.
+
+PPID_LENGTH = 41
+
+class CoordinateStore:
+  CHUNK_SIZE = 1000000
+
+  def __init__(self, filename):
+    ppidChunks = []
+    latChunks = []
+    lngChunks = []
+    nameChunks = []
+    nameParts = []
+    (ppids, lats, lngs, names) = ([], [], [], [])
+    for line in InputStream(filename):
+      try:
+        (ppid, lat, lng, name) = line.rstrip("\n").split(",", 3)
+        (lat, lng) = (float(lat), float(lng))
+      except ValueError:
+        # Not a {ppid},{lat},{lng},{name} line (a header, perhaps)
+        continue
+      ppids.append(ppid)
+      lats.append(lat)
+      lngs.append(lng)
+      names.append(name)
+      if len(ppids) == self.CHUNK_SIZE:
+        self.addChunk(ppidChunks, latChunks, lngChunks, nameChunks, nameParts, \
+            ppids, lats, lngs, names)
+        (ppids, lats, lngs, names) = ([], [], [], [])
+    self.addChunk(ppidChunks, latChunks, lngChunks, nameChunks, nameParts, \
+        ppids, lats, lngs, names)
+
+    ppids = numpy.concatenate(ppidChunks)
+    order = numpy.argsort(ppids, kind="mergesort")
+    self.ppids = ppids[order]
+    self.lats = numpy.concatenate(latChunks)[order]
+    self.lngs = numpy.concatenate(lngChunks)[order]
+    # The names stay in file order, and are found by their (sorted) offsets
+    nameLengths = numpy.concatenate(nameChunks)
+    nameEnds = numpy.cumsum(nameLengths)
+    self.nameStarts = (nameEnds - nameLengths)[order]
+    self.nameEnds = nameEnds[order]
+    self.names = "".join(nameParts)
+
+  def addChunk(self, ppidChunks, latChunks, lngChunks, nameChunks, nameParts, \
+      ppids, lats, lngs, names):
+    """ converts the lists of a chunk of lines to arrays - so that the lists
+      never get any bigger than a chunk """
+    ppidChunks.append(numpy.array(ppids, dtype="S%d" % PPID_LENGTH))
+    latChunks.append(numpy.array(lats, dtype=numpy.float32))
+    lngChunks.append(numpy.array(lngs, dtype=numpy.float32))
+    nameChunks.append(numpy.array([len(name) for name in names], dtype=numpy.int64))
+    nameParts.append("".join(names))
+
+  def __len__(self):
+    return len(self.ppids)
+
+  def locate(self, ppids):
+    """ Returns the (found, lats, lngs) arrays of the ppids - found being False
+      (and the coordinates 0) for those that are not in the store """
+    if len(self.ppids) == 0 or len(ppids) == 0:
+      return (numpy.zeros(len(ppids), dtype=bool), numpy.zeros(len(ppids)), \
+          numpy.zeros(len(ppids)))
+    keys = numpy.array(ppids, dtype="S%d" % PPID_LENGTH)
+    rows = numpy.searchsorted(self.ppids, keys)
+    rows[rows == len(self.ppids)] = 0
+    found = self.ppids[rows] == keys
+    return (found, numpy.where(found, self.lats[rows], 0), \
+        numpy.where(found, self.lngs[rows], 0))
+
+  def lookup(self, ppids):
+    """ Returns a list of (ppid, lat, lng, name) for those of the ppids that are
+      in the store """
+    if len(self.ppids) == 0 or len(ppids) == 0:
+      return []
+    keys = numpy.array(ppids, dtype="S%d" % PPID_LENGTH)
+    rows = numpy.searchsorted(self.ppids, keys)
+    rows[rows == len(self.ppids)] = 0
+    places = []
+    for (ppid, row, found) in zip(ppids, rows.tolist(), \
+        (self.ppids[rows] == keys).tolist()):
+      if found:
+        places.append((ppid, float(self.lats[row]), float(self.lngs[row]), \
+            self.names[self.nameStarts[row]:self.nameEnds[row]]))
+    return places
@@ -0,0 +1,31 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+
+# The names of the countries by their ISO 3166-1 numeric code - the first three
+# digits of a ppid - from the ISO-3166-1.txt next to this module, rather than
+# in the current directory, so that the builders run from anywhere. The table
+# is read once, by the first builder of the process, and then shared (the
+# pool's workers inherit it too).
+
+FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ISO-3166-1.txt")
+
+tables = dict()
+
+def load(filename=FILENAME):
+  """ returns the dict of the country names, by code, of the file's
+    "{code} {name}" lines """
+  try:
+    return tables[filename]
+  except KeyError:
+    pass
+  names = dict()
+  with open(filename) as f:
+    for line in f:
+      line = line.rstrip("\n")
+      if line == "":
+        continue
+      (code, name) = line.split(" ", 1)
+      names[code] = name
+  tables[filename] = names
+  return names
@@ -0,0 +1,267 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import geohash as geohasher
+import numpy
+
+import argparse
+import os
+import sys
+import time
+
+# The "rainbow table" of geohash bounding boxes. The geohashs of a given length
+# never change, so rather than recomputing the 3, 4 & 5 digit bboxes over and
+# over again they are computed once - vectorised, with numpy - into a single
+# array, and looked up by the geohash's base32 value. Every edge of a geohash of
+# up to 5 digits is a multiple of 45/1024 degrees and so is exactly representable
+# as a float32: each cell costs 16 bytes, without any loss of precision.
+#
+# All of the 1 to 5 digit geohashs make for 34,636,832 cells, ~550MB, so when a
+# filename is given the table is persisted there (as a .npy) the first time and
+# memory-mapped after that - only the pages actually looked up get read in.
+#
+# Where there are whole batches of geohashs to decode - of any length, and not
+# just those in the table - decode() does them all in one go, straight from
+# their characters, rather than one geohash.bbox() call at a time. The other
+# way, encode() does whole batches of coordinates at once.
+#
+# Usage: python geohashTable.py [--max-length 5] [--benchmark] [table.npy]
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+DECODE = dict((c, i) for (i, c) in enumerate(BASE32))
+# DECODE as an array indexed by character code, -1 for those not in BASE32
+DECODE_ARRAY = numpy.empty(256, dtype=numpy.int64)
+DECODE_ARRAY.fill(-1)
+for (c, i) in DECODE.items():
+  DECODE_ARRAY[ord(c)] = i
+
+def digitBits(lngFirst):
+  """ returns the arrays of the longitude bits and of the latitude bits of
+    each of the 32 digits, when its first bit is a longitude bit or not """
+  lngBits = numpy.zeros(32, dtype=numpy.int64)
+  latBits = numpy.zeros(32, dtype=numpy.int64)
+  for digit in range(32):
+    for bit in range(5):
+      value = (digit >> (4 - bit)) & 1
+      if (bit % 2 == 0) == lngFirst:
+        lngBits[digit] = (lngBits[digit] << 1) | value
+      else:
+        latBits[digit] = (latBits[digit] << 1) | value
+  return lngBits, latBits
+
+# The bits of a geohash interleave longitude and latitude, longitude first, so
+# the digits alternately start with a longitude bit (3 of them, and 2 latitude
+# bits) and a latitude one (2 and 3)
+DIGIT_BITS = (digitBits(True), digitBits(False))
+
+def cellBounds(values, length):
+  """ returns the (s, w, n, e) arrays of the bounds of the length-digit geohashs
+    whose base32 values are the int64 array values """
+  bits = 5 * length
+  lngBits = (bits + 1) // 2
+  latBits = bits // 2
+  lng = numpy.zeros_like(values)
+  lat = numpy.zeros_like(values)
+  # A digit at a time, most significant first, rather than a bit at a time
+  for column in range(length):
+    digits = (values >> (5 * (length - 1 - column))) & 31
+    (lngDigitBits, latDigitBits) = DIGIT_BITS[column % 2]
+    lng = (lng << (3 - column % 2)) | lngDigitBits[digits]
+    lat = (lat << (2 + column % 2)) | latDigitBits[digits]
+  lngStep = 360.0 / (1 << lngBits)
+  latStep = 180.0 / (1 << latBits)
+  return (lat * latStep - 90.0, lng * lngStep - 180.0, \
+      (lat + 1) * latStep - 90.0, (lng + 1) * lngStep - 180.0)
+
+def decode(geohashs):
+  """ Decodes a batch of geohashs (of up to 12 digits), returning the (s, w,
+    n, e) float64 arrays of their bounds - the same values as geohash.bbox()
+    gives for each. The geohashs are a list (or array) of strings - quickest
+    when they're all the same length - or an (n, length) uint8 array of their
+    characters. Raises ValueError when any of them is not a geohash. """
+  if isinstance(geohashs, numpy.ndarray) and geohashs.dtype == numpy.uint8:
+    chars = geohashs
+  else:
+    geohashs = numpy.asarray(geohashs, dtype=numpy.string_)
+    length = geohashs.dtype.itemsize
+    lengths = numpy.char.str_len(geohashs)
+    if len(geohashs) and lengths.min() < length:
+      return decodeMixed(geohashs, lengths)
+    chars = geohashs.view(numpy.uint8).reshape(len(geohashs), length)
+  (number, length) = chars.shape
+  if length > 12 or length == 0:
+    raise ValueError("can only decode geohashs of 1 to 12 digits")
+  digits = DECODE_ARRAY[chars]
+  # Shorter strings are padded with NULs, which aren't geohash digits either
+  if number and digits.min() < 0:
+    raise ValueError("not all %d-digit geohashs" % length)
+  values = numpy.zeros(number, dtype=numpy.int64)
+  for column in range(length):
+    values = (values << 5) | digits[:, column]
+  return cellBounds(values, length)
+
+def decodeMixed(geohashs, lengths):
+  """ decode() for an array of geohashs of differing lengths: those of each
+    length are decoded together """
+  if lengths.min() == 0:
+    raise ValueError("an empty geohash")
+  bounds = tuple(numpy.empty(len(geohashs)) for i in range(4))
+  for length in numpy.unique(lengths).tolist():
+    rows = numpy.flatnonzero(lengths == length)
+    for (column, values) in zip(bounds, \
+        decode(geohashs[rows].astype("S%d" % length))):
+      column[rows] = values
+  return bounds
+
+def encode(lats, lngs, length):
+  """ Encodes a batch of coordinates, returning the (n, length) uint8 array of
+    the characters of their length-digit geohashs - the same as
+    geohash.encode() gives for each """
+  bits = 5 * length
+  lngBits = (bits + 1) // 2
+  latBits = bits // 2
+  lng = numpy.clip(((numpy.asarray(lngs, dtype=numpy.float64) + 180.0) / 360.0 * \
+      (1 << lngBits)).astype(numpy.int64), 0, (1 << lngBits) - 1)
+  lat = numpy.clip(((numpy.asarray(lats, dtype=numpy.float64) + 90.0) / 180.0 * \
+      (1 << latBits)).astype(numpy.int64), 0, (1 << latBits) - 1)
+  values = numpy.zeros(len(lat), dtype=numpy.int64)
+  for bit in range(bits):
+    if bit % 2 == 0:
+      values = (values << 1) | ((lng >> (lngBits - 1 - bit // 2)) & 1)
+    else:
+      values = (values << 1) | ((lat >> (latBits - 1 - bit // 2)) & 1)
+  base32 = numpy.frombuffer(BASE32, dtype=numpy.uint8)
+  chars = numpy.empty((len(lat), length), dtype=numpy.uint8)
+  for column in range(length - 1, -1, -1):
+    chars[:, column] = base32[values & 31]
+    values = values >> 5
+  return chars
+
+class GeohashBBoxTable:
+  # Columns of the table
+  S, W, N, E = range(4)
+  # The number of geohashs whose rows are built at a time
+  CHUNK = 1 << 16
+
+  def __init__(self, maxLength=5, filename=None):
+    self.maxLength = maxLength
+    # offsets[n] is the row of the first n-digit geohash, offsets[maxLength + 1]
+    # is therefore the number of rows.
+    self.offsets = [0, 0]
+    for length in range(1, maxLength + 1):
+      self.offsets.append(self.offsets[-1] + 32 ** length)
+    numCells = self.offsets[maxLength + 1]
+    if filename is not None and os.path.exists(filename):
+      self.table = numpy.load(filename, mmap_mode="r")
+      if self.table.shape != (numCells, 4):
+        raise ValueError("%s is not a geohash table of up to %d digits" \
+            % (filename, maxLength))
+    elif filename is not None:
+      # Written out a chunk at a time, so the table is never all in memory -
+      # alongside and then renamed, so that an interrupted build can't leave a
+      # truncated table to be mapped by the next
+      f = open("%s.tmp" % filename, "wb")
+      numpy.lib.format.write_array_header_1_0(f, dict(descr="<f4", \
+          fortran_order=False, shape=(numCells, 4)))
+      for (row, rows) in self.build(maxLength):
+        f.write(rows.tostring())
+      f.close()
+      os.rename("%s.tmp" % filename, filename)
+      self.table = numpy.load(filename, mmap_mode="r")
+    else:
+      self.table = numpy.empty((numCells, 4), dtype=numpy.float32)
+      for (row, rows) in self.build(maxLength):
+        self.table[row:row + len(rows)] = rows
+
+  def build(self, maxLength):
+    """ yields (row, rows): the rows of the table from the row on, a chunk of
+      CHUNK geohashs at a time - so the int64 and float64 temporaries of
+      cellBounds stay small, rather than several times the size of the table """
+    for length in range(1, maxLength + 1):
+      for start in range(0, 32 ** length, self.CHUNK):
+        index = numpy.arange(start, min(start + self.CHUNK, 32 ** length), \
+            dtype=numpy.int64)
+        (south, west, north, east) = cellBounds(index, length)
+        rows = numpy.empty((len(index), 4), dtype=numpy.float32)
+        rows[:, self.W] = west
+        rows[:, self.E] = east
+        rows[:, self.S] = south
+        rows[:, self.N] = north
+        yield self.offsets[length] + start, rows
+
+  def row(self, geohash):
+    """ returns the row of the table for the geohash """
+    value = 0
+    for c in geohash:
+      value = (value << 5) | DECODE[c]
+    return self.offsets[len(geohash)] + value
+
+  def bbox(self, geohash):
+    """ A drop-in replacement for geohash.bbox(), falling back to it for the
+      geohashs longer than the table. """
+    if len(geohash) > self.maxLength or len(geohash) == 0:
+      return geohasher.bbox(geohash)
+    (s, w, n, e) = self.table[self.row(geohash)].tolist()
+    return {'s': s, 'w': w, 'n': n, 'e': e}
+
+  def bounds(self, geohashs):
+    """ returns the (west, south, east, north) extent of all of the geohashs -
+      the same as the shapely bounds of their union - decoded in one batch (so
+      they needn't be in the table) """
+    (south, west, north, east) = decode(list(geohashs))
+    return (float(west.min()), float(south.min()), \
+        float(east.max()), float(north.max()))
+
+
+def benchmark(table, length, number):
+  """ lookup and batched decode vs recompute, over a spread of geohashs of the
+    given length """
+  geohashs = []
+  for i in range(number):
+    value = (i * 2654435761) % (32 ** length)
+    geohash = ""
+    for l in range(length):
+      geohash = BASE32[value & 31] + geohash
+      value = value >> 5
+    geohashs.append(geohash)
+  for geohash in geohashs[:1000]:
+    if table.bbox(geohash) != geohasher.bbox(geohash):
+      raise AssertionError("table and geohash.bbox disagree for %s" % geohash)
+  (south, west, north, east) = decode(geohashs[:1000])
+  for (i, geohash) in enumerate(geohashs[:1000]):
+    if {'s': south[i], 'w': west[i], 'n': north[i], 'e': east[i]} != \
+        geohasher.bbox(geohash):
+      raise AssertionError("decode and geohash.bbox disagree for %s" % geohash)
+  start = time.time()
+  for geohash in geohashs:
+    geohasher.bbox(geohash)
+  recompute = time.time() - start
+  start = time.time()
+  for geohash in geohashs:
+    table.bbox(geohash)
+  lookup = time.time() - start
+  start = time.time()
+  decode(geohashs)
+  batched = time.time() - start
+  print "%d-digit: geohash.bbox %.3fus, table lookup %.3fus (%.1fx), " \
+      "batched decode %.3fus (%.1fx) per geohash" % (length, \
+      1e6 * recompute / number, 1e6 * lookup / number, recompute / lookup, \
+      1e6 * batched / number, recompute / batched)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description="Builds (and optionally persists) the geohash bbox table")
+  parser.add_argument("filename", nargs="?", help="the .npy to persist to/map")
+  parser.add_argument("--max-length", type=int, default=5)
+  parser.add_argument("--benchmark", action="store_true",
+      help="compare table lookups and batched decodes with geohash.bbox()")
+  parser.add_argument("--number", type=int, default=200000)
+  args = parser.parse_args()
+  start = time.time()
+  table = GeohashBBoxTable(args.max_length, args.filename)
+  print "%d cells (%dMB) ready in %.2fs" % (table.table.shape[0], \
+      table.table.nbytes >> 20, time.time() - start)
+  if args.benchmark:
+    for length in range(1, args.max_length + 1):
+      benchmark(table, length, args.number)
+  sys.exit(0)
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import numpy
+
+# An in-memory replacement for the ./data-root/{cc}/{gh3}/{g4}/{g5}/ directory
+# tree that KmlBuilder otherwise creates - one file per ppid. The trie has the
+# very same shape as that tree: the root has one child per country code, each
+# country has one child per 3-digit geohash, and below that each level adds a
+# single geohash character. The keys of the children are therefore exactly the
+# directory names that would have been created, so the KML hierarchy (and its
+# relative hrefs) comes out the same.
+# An adapted trie (see adapt) is no longer that fixed shape: its dense 5-digit
+# geohashs are split into 6, 7, ... digit ones, and chains of nodes with just
+# the one child are collapsed into one key of several characters - so the
+# keys are still directory names, and a node's geohash is still all of the
+# keys below the country's joined together.
+
+class GeohashNode(object):
+  """ A single "directory" of the trie. numPoi is the number of POI at or below
+    this node (kept up to date as ppids are added, so no aggregation pass is
+    needed), ppids are only ever found at the 5-digit geohash leaves (or
+    anywhere below the countries, once adapted) - as a list of strings, or an
+    array of packed ppids (see ppidRecords.py) when they were added a whole
+    cell at a time. """
+  __slots__ = ("children", "ppids", "numPoi")
+
+  def __init__(self):
+    self.children = dict()
+    self.ppids = []
+    self.numPoi = 0
+
+
+def take(ppids, rows):
+  """ returns the ppids of the rows - of a list of strings, or an array of
+    packed ppids """
+  if isinstance(ppids, numpy.ndarray):
+    return ppids[rows]
+  return [ppids[row] for row in rows.tolist()]
+
+
+class GeohashTrie:
+  def __init__(self):
+    self.root = GeohashNode()
+
+  def ppidToPath(self, ppid):
+    """ returns the list of keys - the directory names - that the ppid lives
+      under, or None when it does not look like a ppid at all """
+    # ppids look like this: 724ezjmd-e400738407474eb9b82e1e16ecb8efbc
+    try:
+      (cc_gh, uuid) = ppid.split('-')
+    except ValueError:
+      return None
+    # A geohash of just 1 or 2 digits has no 3-digit geohash to be drawn in
+    # (which the directory build leaves out of its country too), so the ppid is
+    # rejected - as ppidRecords.pack does
+    if 3 < len(cc_gh) < 6:
+      return None
+    path = []
+    for key in (cc_gh[:3], cc_gh[3:6], cc_gh[6:7], cc_gh[7:8]):
+      if key == "":
+        break
+      path.append(key)
+    return path
+
+  def add(self, ppid):
+    """ Adds the ppid, returning the country code and 3-digit geohash in the
+      same way as KmlBuilder.addToDirectory does. """
+    path = self.ppidToPath(ppid)
+    if path is None:
+      return None, None
+    node = self.root
+    node.numPoi = node.numPoi + 1
+    for key in path:
+      try:
+        node = node.children[key]
+      except KeyError:
+        child = GeohashNode()
+        node.children[key] = child
+        node = child
+      node.numPoi = node.numPoi + 1
+    node.ppids.append(ppid)
+    countryCode = None
+    geohash = None
+    if len(path) > 0:
+      countryCode = path[0]
+    if len(path) > 1:
+      geohash = path[1]
+    return countryCode, geohash
+
+  def addCell(self, cell, ppids):
+    """ Adds all of the ppids of a {cc:3}{gh:5} cell - which is not yet in the
+      trie - at once. The ppids are kept as they are given: a slice of packed
+      records, say, rather than a list of strings. """
+    path = (cell[:3], cell[3:6], cell[6:7], cell[7:8])
+    node = self.root
+    node.numPoi = node.numPoi + len(ppids)
+    for key in path:
+      try:
+        node = node.children[key]
+      except KeyError:
+        child = GeohashNode()
+        node.children[key] = child
+        node = child
+      node.numPoi = node.numPoi + len(ppids)
+    node.ppids = ppids
+
+  def adapt(self, maxPoi, locate, maxLength):
+    """ Adapts the trie to the density of the POI: every node with more than
+      maxPoi ppids of its own is split into the next digit's geohashs - and
+      they in turn, until none has too many or they are maxLength digits long.
+      Then each chain of nodes below the 3-digit geohashs that have just the
+      one child, and no ppids of their own, is collapsed into its last node.
+      locate(ppids, length) returns the (n, length) uint8 array of the
+      characters of the length-digit geohashs of the ppids, rows of zeros for
+      those it can't place - which stay where they are. Returns the number of
+      nodes split. """
+    numSplit = 0
+    for path, node in list(self.walk()):
+      if len(path) > 1 and len(node.ppids) > maxPoi:
+        geohash = "".join(path[1:])
+        if len(geohash) < maxLength:
+          chars = locate(node.ppids, maxLength)
+          numSplit = numSplit + self.split(node, geohash, chars, maxPoi)
+    for countryCode, countryNode in self.countries():
+      for geohash in countryNode.children:
+        self.collapse(countryNode.children[geohash])
+    return numSplit
+
+  def split(self, node, geohash, chars, maxPoi):
+    """ splits the node, of the geohash, whose ppids' geohashs' characters are
+      chars - returning the number of nodes split """
+    depth = len(geohash)
+    ppids = node.ppids
+    prefix = numpy.frombuffer(geohash, dtype=numpy.uint8)
+    # Only the ppids whose coordinates are in the node's geohash can be placed
+    # in its children
+    placed = (chars[:, :depth] == prefix).all(axis=1)
+    digits = numpy.where(placed, chars[:, depth], 0)
+    node.ppids = take(ppids, numpy.flatnonzero(digits == 0))
+    numSplit = 1
+    for digit in numpy.unique(digits[digits != 0]).tolist():
+      rows = numpy.flatnonzero(digits == digit)
+      child = GeohashNode()
+      child.ppids = take(ppids, rows)
+      child.numPoi = len(rows)
+      node.children[chr(digit)] = child
+      if len(rows) > maxPoi and depth + 1 < chars.shape[1]:
+        numSplit = numSplit + self.split(child, geohash + chr(digit), \
+            chars[rows], maxPoi)
+    return numSplit
+
+  def collapse(self, node):
+    """ collapses the chains of single children below the node """
+    stack = [node]
+    while stack:
+      node = stack.pop()
+      for key in list(node.children):
+        child = node.children[key]
+        collapsedKey = key
+        while len(child.children) == 1 and len(child.ppids) == 0:
+          (childKey, child) = child.children.items()[0]
+          collapsedKey = collapsedKey + childKey
+        if collapsedKey != key:
+          del node.children[key]
+          node.children[collapsedKey] = child
+        stack.append(child)
+
+  def remove(self, ppid):
+    """ Removes the ppid, pruning any nodes that are left empty. Returns False
+      when the ppid was not there to be removed. """
+    path = self.ppidToPath(ppid)
+    if path is None:
+      return False
+    nodes = [self.root]
+    for key in path:
+      try:
+        nodes.append(nodes[-1].children[key])
+      except KeyError:
+        return False
+    try:
+      nodes[-1].ppids.remove(ppid)
+    except ValueError:
+      return False
+    for node in nodes:
+      node.numPoi = node.numPoi - 1
+    for depth in range(len(path), 0, -1):
+      if nodes[depth].numPoi == 0:
+        del nodes[depth - 1].children[path[depth - 1]]
+    return True
+
+  def countries(self):
+    """ yields (countryCode, countryNode) in country code order """
+    # (The children of a HierarchyIndex's node are read anew each time they
+    # are asked for, so here and in walk they are only asked for the once)
+    countries = self.root.children
+    for countryCode in sorted(countries):
+      yield countryCode, countries[countryCode]
+
+  def walk(self, node=None, path=()):
+    """ Yields (path, node) for every node, children before their parents - the
+      same order as os.walk(topdown=False) gives for the directory tree. The
+      path is the tuple of keys from the root, so () is the root itself. """
+    if node is None:
+      node = self.root
+    # An explicit stack, as the recursion is only 5 deep but there are a great
+    # many nodes and generators-of-generators are slow.
+    stack = [(path, node, False)]
+    while stack:
+      (path, node, expanded) = stack.pop()
+      if expanded:
+        yield path, node
+        continue
+      children = node.children
+      if not children:
+        yield path, node
+        continue
+      stack.append((path, node, True))
+      for key in sorted(children, reverse=True):
+        stack.append((path + (key,), children[key], False))
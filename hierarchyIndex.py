@@ -0,0 +1,248 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import collections
+import itertools
+import mmap
+import os
+
+import numpy
+from numpy.lib.format import open_memmap
+
+from geohashTable import decode
+from geohashTrie import GeohashTrie
+import ppidRecords
+
+# A binary index of a built hierarchy, so that its KML can be rendered again -
+# with other styles, Lods and so on - without reading and sorting all of the
+# POI again. It's two files in the data root:
+#   hierarchy.npy     a row per node (cell) of the hierarchy: its {cc}{gh},
+#                     number of descendent POI, extent, where its children's
+#                     rows are, and where its own ppids are in
+#   hierarchy.ppids   the ppids of all of the nodes, a line each
+# The rows are in breadth first order - the root, then the countries, then all
+# of their 3-digit geohashs, ... - so the children of a node are always the
+# consecutive rows firstChild to firstChild + numChildren - 1, in key order.
+# Both files are memory-mapped when read, so only the rows of the nodes being
+# rendered are ever read in. A HierarchyIndex walks just like a GeohashTrie
+# does, and can be rendered by KmlBuilder in the very same way.
+#
+# The subtrees below the countries' children are written as blocks, in any
+# order, as their numbers of rows are known up front: a block's rows are those
+# of its subtree with offsets relative to its first row (which becomes the row
+# of the country's child) and to the start of its ppids.
+
+NODES_FILE = "hierarchy.npy"
+PPIDS_FILE = "hierarchy.ppids"
+
+# A cell is up to 15 characters: the country code and up to a 12-digit geohash,
+# as the cells of an adapted trie may be longer than 5 digits
+NODE = numpy.dtype([("cell", "S16"), ("numPoi", "<u8"), ("firstChild", "<u4"),
+    ("numChildren", "<u4"), ("ppidOffset", "<u8"), ("ppidBytes", "<u8"),
+    ("numPpids", "<u4"), ("w", "<f8"), ("s", "<f8"), ("e", "<f8"), ("n", "<f8")])
+
+# The extents of the geohashs are filled in this many rows at a time
+CHUNK_SIZE = 1000000
+
+def subtreeSize(node):
+  """ returns the number of nodes in the subtree """
+  size = 0
+  stack = [node]
+  while stack:
+    node = stack.pop()
+    size = size + 1
+    stack.extend(node.children.values())
+  return size
+
+def subtreeRows(cell, node, f):
+  """ Returns the block of rows of the subtree of the node, whose {cc}{gh} is
+    cell, writing its ppids to the file f as it goes """
+  rows = []
+  offset = 0
+  nextRow = 1
+  queue = collections.deque([(cell, node)])
+  while queue:
+    (cell, node) = queue.popleft()
+    keys = sorted(node.children)
+    ppids = ppidRecords.toPpids(node.ppids)
+    data = "".join(ppid + "\n" for ppid in ppids)
+    f.write(data)
+    firstChild = 0
+    if keys:
+      firstChild = nextRow
+    rows.append((cell, node.numPoi, firstChild, len(keys), offset, len(data), \
+        len(ppids), 0, 0, 0, 0))
+    offset = offset + len(data)
+    nextRow = nextRow + len(keys)
+    for key in keys:
+      queue.append((cell + key, node.children[key]))
+  return numpy.array(rows, dtype=NODE)
+
+
+class IndexWriter:
+  """ Writes the index of a hierarchy whose root and countries are those of
+    the trie - their children, and below, being added as blocks - given the
+    number of rows of every block, keyed by (countryCode, key). """
+  def __init__(self, dataRoot, trie, blockSizes):
+    self.dataRoot = dataRoot
+    countries = list(trie.countries())
+    blocks = sorted(blockSizes)
+    numRows = 1 + len(countries) + sum(blockSizes.values())
+    self.nodes = open_memmap("%s/%s.tmp" % (dataRoot, NODES_FILE), mode="w+", \
+        dtype=NODE, shape=(numRows,))
+    self.ppids = open("%s/%s.tmp" % (dataRoot, PPIDS_FILE), "wb")
+    # Each block's first row is amongst those of the countries' children, the
+    # rest of its rows follow on after all of those
+    firstBlockRow = 1 + len(countries)
+    self.blockRows = dict()
+    nextRow = firstBlockRow + len(blocks)
+    for (i, block) in enumerate(blocks):
+      self.blockRows[block] = (firstBlockRow + i, nextRow)
+      nextRow = nextRow + blockSizes[block] - 1
+
+    self.writeRow(0, "", trie.root, 1, len(countries))
+    for (i, (countryCode, countryNode)) in enumerate(countries):
+      keys = sorted(countryNode.children)
+      firstChild = 0
+      if keys:
+        firstChild = self.blockRows[(countryCode, keys[0])][0]
+      self.writeRow(1 + i, countryCode, countryNode, firstChild, len(keys))
+
+  def writeRow(self, row, cell, node, firstChild, numChildren):
+    ppids = ppidRecords.toPpids(node.ppids)
+    data = "".join(ppid + "\n" for ppid in ppids)
+    self.nodes[row] = (cell, node.numPoi, firstChild, numChildren, \
+        self.ppids.tell(), len(data), len(ppids), 0, 0, 0, 0)
+    self.ppids.write(data)
+
+  def addBlock(self, countryCode, key, rows, ppidOffset):
+    """ adds the block of rows of the subtree of the country's child key, whose
+      ppids were written to self.ppids from ppidOffset on """
+    (row, nextRow) = self.blockRows[(countryCode, key)]
+    rows["ppidOffset"] += ppidOffset
+    hasChildren = rows["numChildren"] > 0
+    rows["firstChild"][hasChildren] += nextRow - 1
+    self.nodes[row] = rows[0]
+    self.nodes[nextRow:nextRow + len(rows) - 1] = rows[1:]
+
+  def close(self, countrysBounds):
+    """ fills in the extents - the countries' from their bounds, the root's
+      being all of theirs - and puts the index in place """
+    nodes = self.nodes
+    numCountries = int(nodes[0]["numChildren"])
+    extents = []
+    for row in range(1, 1 + numCountries):
+      bounds = countrysBounds.get(nodes[row]["cell"], (numpy.nan,) * 4)
+      (nodes["w"][row], nodes["s"][row], nodes["e"][row], nodes["n"][row]) = bounds
+      extents.append(bounds)
+    if extents:
+      extents = numpy.array(extents)
+      (nodes["w"][0], nodes["s"][0]) = numpy.nanmin(extents[:, :2], axis=0)
+      (nodes["e"][0], nodes["n"][0]) = numpy.nanmax(extents[:, 2:], axis=0)
+    for start in range(1 + numCountries, len(nodes), CHUNK_SIZE):
+      end = min(start + CHUNK_SIZE, len(nodes))
+      geohashs = [cell[3:] for cell in nodes["cell"][start:end].tolist()]
+      (nodes["s"][start:end], nodes["w"][start:end], nodes["n"][start:end], \
+          nodes["e"][start:end]) = decode(geohashs)
+    nodes.flush()
+    del self.nodes
+    self.ppids.close()
+    for filename in (NODES_FILE, PPIDS_FILE):
+      os.rename("%s/%s.tmp" % (self.dataRoot, filename), \
+          "%s/%s" % (self.dataRoot, filename))
+
+
+def save(dataRoot, trie, countrysBounds):
+  """ writes the index of the whole of a trie """
+  blockSizes = dict()
+  for countryCode, countryNode in trie.countries():
+    for key in countryNode.children:
+      blockSizes[(countryCode, key)] = subtreeSize(countryNode.children[key])
+  writer = IndexWriter(dataRoot, trie, blockSizes)
+  for countryCode, countryNode in trie.countries():
+    for key in sorted(countryNode.children):
+      ppidOffset = writer.ppids.tell()
+      rows = subtreeRows(countryCode + key, countryNode.children[key], writer.ppids)
+      writer.addBlock(countryCode, key, rows, ppidOffset)
+  writer.close(countrysBounds)
+
+
+class IndexNode(object):
+  """ A node of a HierarchyIndex, with the same numPoi, children and ppids as a
+    GeohashNode - read from the index as they are asked for. The children are
+    not kept, so that only the nodes being rendered are ever made: they are
+    read anew each time, so are best asked for just the once. Each node is
+    made with the columns of its row that the walk needs, read along with
+    those of its siblings. """
+  __slots__ = ("index", "row", "cell", "numPoi", "firstChild", "numChildren")
+
+  def __init__(self, index, row, cell, numPoi, firstChild, numChildren):
+    self.index = index
+    self.row = row
+    self.cell = cell
+    self.numPoi = numPoi
+    self.firstChild = firstChild
+    self.numChildren = numChildren
+
+  @property
+  def children(self):
+    children = dict()
+    # Leaves needn't read the index at all
+    if self.numChildren == 0:
+      return children
+    index = self.index
+    rows = slice(self.firstChild, self.firstChild + self.numChildren)
+    prefix = len(self.cell)
+    for (row, cell, numPoi, firstChild, numChildren) in itertools.izip( \
+        itertools.count(self.firstChild), index.cell[rows].tolist(), \
+        index.numPoi[rows].tolist(), index.firstChild[rows].tolist(), \
+        index.numChildren[rows].tolist()):
+      children[cell[prefix:]] = IndexNode(index, row, cell, numPoi, firstChild, \
+          numChildren)
+    return children
+
+  @property
+  def ppids(self):
+    index = self.index
+    numBytes = int(index.ppidBytes[self.row])
+    if numBytes == 0:
+      return []
+    start = int(index.ppidOffset[self.row])
+    return index.ppids[start:start + numBytes].split("\n")[:-1]
+
+
+class HierarchyIndex:
+  def __init__(self, dataRoot):
+    self.nodes = numpy.load("%s/%s" % (dataRoot, NODES_FILE), mmap_mode="r")
+    if self.nodes.dtype != NODE:
+      raise ValueError("%s/%s is not a hierarchy index" % (dataRoot, NODES_FILE))
+    # The columns the hierarchy is walked and rendered by, as plain arrays -
+    # still mapped, but without the cost of a numpy.memmap for every slice
+    nodes = self.nodes.view(numpy.ndarray)
+    self.cell = nodes["cell"]
+    self.numPoi = nodes["numPoi"]
+    self.firstChild = nodes["firstChild"]
+    self.numChildren = nodes["numChildren"]
+    self.ppidOffset = nodes["ppidOffset"]
+    self.ppidBytes = nodes["ppidBytes"]
+    self.ppids = ""
+    f = open("%s/%s" % (dataRoot, PPIDS_FILE), "rb")
+    if os.fstat(f.fileno()).st_size > 0:
+      self.ppids = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    f.close()
+    self.root = IndexNode(self, 0, *nodes[["cell", "numPoi", "firstChild", \
+        "numChildren"]][0].tolist())
+
+  # The index is walked in just the same way as the trie
+  countries = GeohashTrie.__dict__["countries"]
+  walk = GeohashTrie.__dict__["walk"]
+
+  def countrysBounds(self):
+    """ returns the (west, south, east, north) of the countries that have
+      them """
+    bounds = dict()
+    for row in range(1, 1 + int(self.nodes[0]["numChildren"])):
+      node = self.nodes[row]
+      if not numpy.isnan(node["w"]):
+        bounds[node["cell"]] = (float(node["w"]), float(node["s"]), \
+            float(node["e"]), float(node["n"]))
+    return bounds
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import bz2
+import os
+import sys
+import zlib
+
+# The POI and view count files are far too big to readlines() in one go, so
+# both the KmlBuilder and PpidCounts2KML consume them as a stream of lines.
+# Compressed input is recognised by its magic bytes rather than its name, so
+# that a gzip'ed stream on stdin works just as well as a .gz file. Progress is
+# reported against the (compressed) bytes actually read from the file.
+
+class InputStream:
+  CHUNK_SIZE = 1 << 20
+  GZIP_MAGIC = "\x1f\x8b"
+  BZ2_MAGIC = "BZh"
+
+  def __init__(self, filename):
+    """ filename may be "-" for stdin """
+    self.filename = filename
+    self.bytesRead = 0
+    self.totalBytes = None
+    if filename == "-":
+      self.raw = sys.stdin
+    else:
+      self.raw = open(filename, "rb")
+      try:
+        self.totalBytes = os.fstat(self.raw.fileno()).st_size
+      except OSError:
+        pass
+
+  def newDecompressor(self, magic):
+    if magic.startswith(self.GZIP_MAGIC):
+      # 16 + MAX_WBITS: expect the gzip header and trailer
+      return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if magic.startswith(self.BZ2_MAGIC):
+      return bz2.BZ2Decompressor()
+    return None
+
+  def read(self):
+    chunk = self.raw.read(self.CHUNK_SIZE)
+    self.bytesRead = self.bytesRead + len(chunk)
+    return chunk
+
+  def chunks(self):
+    """ yields the decompressed content, a chunk at a time """
+    chunk = self.read()
+    # The magic bytes may not all be there in a very short first read
+    while 0 < len(chunk) < len(self.BZ2_MAGIC):
+      more = self.read()
+      if not more:
+        break
+      chunk = chunk + more
+    decompressor = self.newDecompressor(chunk)
+    if decompressor is None:
+      while chunk:
+        yield chunk
+        chunk = self.read()
+      return
+    # Concatenated gzip/bz2 members (as made by "cat a.gz b.gz" or by pbzip2)
+    # each need their own decompressor. A member ends either with the start of
+    # the next one in unused_data - perhaps just its first byte or two - or,
+    # when it ends with the read, with the next read being refused: bz2 raises
+    # EOFError, where zlib puts it all in unused_data.
+    while chunk:
+      if decompressor is None:
+        while len(chunk) < len(self.BZ2_MAGIC):
+          more = self.read()
+          if not more:
+            break
+          chunk = chunk + more
+        decompressor = self.newDecompressor(chunk)
+        if decompressor is None:
+          raise IOError("%s: not a gzip or bz2 member after %d bytes" % \
+              (self.filename, self.bytesRead - len(chunk)))
+      try:
+        data = decompressor.decompress(chunk)
+      except EOFError:
+        decompressor = None
+        continue
+      if data:
+        yield data
+      chunk = decompressor.unused_data
+      if chunk:
+        decompressor = None
+      else:
+        chunk = self.read()
+    if hasattr(decompressor, "flush"):
+      data = decompressor.flush()
+      if data:
+        yield data
+
+  def __iter__(self):
+    """ yields the lines, each with its trailing newline, as file objects do """
+    tail = ""
+    for data in self.chunks():
+      lines = (tail + data).split("\n")
+      tail = lines.pop()
+      for line in lines:
+        yield line + "\n"
+    if tail:
+      yield tail
+    self.close()
+
+  def percent(self):
+    """ the percentage of the file read so far, or None when it's unknown """
+    if not self.totalBytes:
+      return None
+    return int(100 * self.bytesRead / self.totalBytes)
+
+  def progress(self):
+    percent = self.percent()
+    if percent is None:
+      return "%dMB" % (self.bytesRead >> 20)
+    return "%d%%" % percent
+
+  def close(self):
+    if self.raw is not sys.stdin:
+      self.raw.close()
@@ -1,16 +1,28 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
-import geohash as geohasher
-
-# http://toblerity.github.com/shapely/
-from shapely.geometry import Polygon
-from shapely.ops import cascaded_union
+import numpy
 
+import argparse
+import itertools
 import sys
 import os
 import pprint
+import shutil
 import time
 
+from coordinateStore import CoordinateStore
+import countryTable
+from geohashTable import GeohashBBoxTable, decode, encode
+from geohashTrie import GeohashNode, GeohashTrie
+from inputStream import InputStream
+import kmlWriter
+import lodTuning
+import ppidRecords
+import stageProfiler
+# The modules that only some of the builds need - multiprocessing, tempfile,
+# xml.sax.saxutils, hierarchyIndex, manifest and tileServer - are imported by
+# the methods that use them, so that the others don't wait for them to load
+
 # Note: not using pyKML as the dependencies for lxml are not acceptable at this
 # time on my machine, hence manual building of KML. As all of the KML being used
 # here is quite simple, that's not a major problem.
@@ -55,28 +67,159 @@ import time
 #       directories are found with a simple lookup strategy. 
 # 4/ Once the directories are populated, they are iterated over to build
 #    directory-specific metadata. 
-# TODO:
-# 1/ Build a rainbow table of the geohashs. We don't _really_ need to keep
-#    recomputing the 3,4 & 5 digit geohashs as they don't change - looking them
-#    up ought to do nicely.
+# With --in-memory the directories of steps 2 and 3 are instead the nodes of a
+# GeohashTrie (see geohashTrie.py) and the filesystem is only written to for
+# the KML itself - on large runs the one-file-per-POI approach means tens of
+# millions of open/write/close calls, and two walks of the resulting tree.
+# The 3, 4 & 5 digit geohashs don't change, so rather than recomputing their
+# bboxes they are looked up in a GeohashBBoxTable (see geohashTable.py): the 1
+# to 4 digit geohashs in memory, or all of the 1 to 5 digit ones memory-mapped
+# from --bbox-table.
+# With --compact the ppids are read a chunk at a time and packed into 24-byte
+# records (see ppidRecords.py) rather than kept as strings, sorted by cell and
+# added to the trie a whole cell at a time.
+# With --spill DIR not even that is held: the ppids are first partitioned by
+# their {cc:3}{gh:3} into spill files under DIR, and then each partition in
+# turn is read into a trie of its own and written out - so memory is bounded by
+# the largest 3-digit geohash rather than by all of the POI. Only the counts of
+# the 3-digit geohashs are kept, for the KML of the countries and the root.
+# With --index, builds also leave a binary index of the hierarchy in the data
+# root (see hierarchyIndex.py), from which --render can write all of its KML
+# again - with changed styles or Lods, as KMZs, ... - without the POI file.
+# With --serve PORT nothing is written at all: the documents are served over
+# HTTP (see tileServer.py), each rendered from the hierarchy - read from the POI
+# file, or that index - as it's asked for.
+# With --profile FILE the wall & CPU time, peak RSS, items & files of each stage
+# of the build - by country, for the stages that go a country at a time - are
+# reported to FILE as JSON (see stageProfiler.py), and --cprofile runs one of
+# the stages under cProfile.
+# With --adaptive N the hierarchy follows the density of the POI rather than
+# always being gh3/g4/g5: the geohashs with more than N POI are split into 6,
+# 7, ... digit ones (by the POI's --coordinates), and the chains of cells that
+# have just the one inner geohash are skipped - linking straight to the cell at
+# the end of the chain, as in ./mq/index.kml. So each document has at most 32
+# NetworkLinks and, where there are coordinates, about N Placemarks.
+# With --lod the Lods of the NetworkLinks, and of the borders, are tuned to the
+# size of the geohashs and the density of their POI (see lodTuning.py) rather
+# than all being the same, and with --merge-poi N the inner geohashs of no more
+# than N POI are drawn as one Placemark until the client is close in.
 
 class KmlBuilder:
   DATA_ROOT = "./data-root"
   countryCodes = dict()
+  countrysGeohashs = dict()
+  countrysBounds = dict()
   countrysPolygon = dict()
+  outlines = False
+  workers = 1
+  incremental = False
+  deltaFile = None
+  cellCounts = dict()
+  numPoiFiles = False
+  kmzLevel = None
+  extension = "kml"
+  coordinates = None
+  coordinatesFile = None
+  maxPlacemarks = 500
   poiFile = None
   heightMultiplier = 0
+  trie = None
+  compact = False
+  spillDir = None
+  indexHierarchy = False
+  render = False
+  servePort = None
+  serveCacheSize = 10000
+  profiler = None
+  profileFile = None
+  adaptivePoi = None
+  lods = None
+  # Cells are split no deeper than this
+  ADAPTIVE_MAX_LENGTH = 9
+  # The number of files - KML and, in the directory build, one per POI - this
+  # process has written
+  filesWritten = 0
+  # The spilled ppids are buffered, and written out when there are this many
+  SPILL_BUFFER = 1000000
+  bboxTable = None
+  bboxTableFile = None
 
-  def __init__(self, poiFile, heightMultiplier=1):
+  def __init__(self, poiFile, heightMultiplier=1, inMemory=False,
+      bboxTableFile=None, outlines=False, workers=1, incremental=False,
+      deltaFile=None, numPoiFiles=False, kmzLevel=None, coordinatesFile=None,
+      maxPlacemarks=500, compact=False, spillDir=None, indexHierarchy=False,
+      render=False, servePort=None, serveCacheSize=10000, profileFile=None,
+      cprofileStage=None, cprofileFile=None, adaptivePoi=None, tuneLods=False,
+      mergePoi=None):
     print poiFile
-    countryCodes = dict()
-    with open("%s/ISO-3166-1.txt" % os.getcwd()) as f:
-      content = f.readlines()
-    for line in content:
-      (code, name) = line.split(' ', 1)
-      self.countryCodes[code] = name[:-1]
+    self.countryCodes = countryTable.load()
+    # Each stage is always timed, but only reported with a profile file
+    self.profileFile = profileFile
+    self.profiler = stageProfiler.StageProfiler(cprofileStage, cprofileFile)
     self.poiFile = poiFile
     self.heightMultiplier = heightMultiplier
+    self.outlines = outlines
+    self.workers = workers
+    self.numPoiFiles = numPoiFiles
+    # Each document is written as a KMZ when there is a compression level for
+    # them, and the NetworkLinks link to the KMZs.
+    self.kmzLevel = kmzLevel
+    if kmzLevel is not None:
+      self.extension = "kmz"
+    self.maxPlacemarks = maxPlacemarks
+    self.coordinatesFile = coordinatesFile
+    # Merging small geohashs is only done with tuned Lods
+    if tuneLods or mergePoi is not None:
+      self.lods = lodTuning.LodTuning(maxPlacemarks if coordinatesFile else 0, \
+          mergePoi)
+    if coordinatesFile is not None:
+      print "Loading coordinates ... ",
+      sys.stdout.flush()
+      startMillis = int(round(time.time() * 1000))
+      stage = self.profiler.start("coordinates")
+      self.coordinates = CoordinateStore(coordinatesFile)
+      stage.stop(items=len(self.coordinates))
+      endMillis = int(round(time.time() * 1000))
+      print "%d POI in %d millis" % (len(self.coordinates), (endMillis - startMillis))
+    # A delta can only be applied to an incremental build, and incremental
+    # builds are always made in memory.
+    self.deltaFile = deltaFile
+    self.incremental = incremental or deltaFile is not None
+    # The packed ppids are only for full builds: an incremental one needs the
+    # ppid strings for its manifest.
+    self.compact = compact and not self.incremental
+    if not self.incremental:
+      self.spillDir = spillDir
+    self.indexHierarchy = indexHierarchy
+    self.render = render
+    # Only a trie that's built in one go can be adapted: an incremental one
+    # has to keep the shape its manifest has
+    if not self.incremental:
+      self.adaptivePoi = adaptivePoi
+    # Served documents are rendered as they are asked for, from a trie
+    self.servePort = servePort
+    self.serveCacheSize = serveCacheSize
+    if servePort is not None:
+      self.trie = GeohashTrie()
+    # A spilled build's trie only ever has the countries and their 3-digit
+    # geohashs, with their counts, in it
+    if inMemory or self.incremental or self.compact or self.spillDir is not None:
+      self.trie = GeohashTrie()
+    # The bbox table is only built when the first bbox is looked up: it takes
+    # a while, and a build that never draws a geohash needn't wait for it
+    self.bboxTableFile = bboxTableFile
+
+  def bboxes(self):
+    """ returns the GeohashBBoxTable, building it the first time """
+    if self.bboxTable is None:
+      if self.bboxTableFile is None:
+        self.bboxTable = GeohashBBoxTable(4)
+      else:
+        self.bboxTable = GeohashBBoxTable(5, self.bboxTableFile)
+    return self.bboxTable
+
+  def bbox(self, geohash):
+    return self.bboxes().bbox(geohash)
 
   def ccGeohashToDirname(self, ccGh):
     """ returns the {country-code:3}{geohash:5} as a string representing the
@@ -103,12 +246,22 @@ class KmlBuilder:
 
 
 
+  def pathToDirname(self, path):
+    """ returns the directory for a GeohashTrie path (the tuple of keys) """
+    return "/".join((KmlBuilder.DATA_ROOT,) + path)
+
+  def cellToDirname(self, cell):
+    """ returns the directory of a manifest cell - a {country-code:3}{geohash} """
+    return os.path.normpath(self.ccGeohashToDirname(cell))
+
   def ensureDirectory(self, ccGh):
     """ Creates an appropriate directory from the {country-code:3}{geohash:5) if
       it does not exist. Note that filesystem caches are faster than trying to
       keep track of whether we have already created this - even on a spinning
       HDD, very much more so on an SSD. """
-    dirname = self.ccGeohashToDirname(ccGh)
+    return self.makeDirectory(self.ccGeohashToDirname(ccGh))
+
+  def makeDirectory(self, dirname):
     try:
       os.makedirs(dirname)
     except OSError:
@@ -126,6 +279,7 @@ class KmlBuilder:
     f = open(dir + "/" + ppid, "w")
     f.write(ppid)
     f.close()
+    self.filesWritten = self.filesWritten + 1
 
   def addToDirectory(self, ppid):
     countryCode = None
@@ -133,133 +287,181 @@ class KmlBuilder:
     # ppids look like this: 724ezjmd-e400738407474eb9b82e1e16ecb8efbc
     try:
       (cc_gh, uuid) = ppid.split('-')
+      # A geohash of just 1 or 2 digits is in no 3-digit geohash of its country
+      # to be drawn in, so it is rejected - as GeohashTrie.ppidToPath does
+      if 3 < len(cc_gh) < 6:
+        return countryCode, geohash
       dir = self.ensureDirectory(cc_gh)
       self.addToThisDirectory(dir, ppid)
+      self.countPOI(cc_gh)
       countryCode = cc_gh[:3]
       geohash = cc_gh[3:6]
     except ValueError:
       pass
     return countryCode, geohash
 
+  def countPOI(self, ccGh):
+    """ counts a POI in its {country-code:3}{geohash:5} cell - the directory
+      it's added to. The counts of the cells above are only summed up once all
+      of the POI are in, by aggregateCounts. """
+    cell = ccGh[:8]
+    try:
+      self.cellCounts[cell] = self.cellCounts[cell] + 1
+    except KeyError:
+      self.cellCounts[cell] = 1
+
+  def aggregateCounts(self):
+    """ Adds the count of every 5-digit cell to each of the cells above it, up
+      to the root (the cell ""), in one pass over the 5-digit cells - so the
+      descendent counts don't depend on the order the directories are walked
+      in, or on reading them back from num.poi files. """
+    stage = self.profiler.start("aggregate")
+    counts = dict()
+    for cell, numPoi in self.cellCounts.iteritems():
+      for length in (0, 3, 6, 7, 8):
+        prefix = cell[:length]
+        counts[prefix] = counts.get(prefix, 0) + numPoi
+        if length >= len(cell):
+          break
+    stage.stop(items=len(self.cellCounts))
+    self.cellCounts = counts
+
   def addGeohashToCountry(self, countryCode, geohash):
-    ''' using some complex geometry unioning here! '''
+    """ Notes the 3-digit geohash as being (at least partly) in the country. The
+      country extents are computed from these by computeCountryExtents. """
     if geohash is None:
       return
     # Here's an optimisation - without which a 45M POI run was taking well over
     # 12 hours. We're drawing the largest regions using 3-digit geohashs, and
-    # each POI will live in one of these. The calculation of "within" is really
-    # expensive and I'd like to avoid doing it - so to dramatically cut the
-    # time, the best way is to dramatically cut the number of times it's done.
+    # each POI will live in one of these. 
     if len(geohash) != 3:
       return
-    b = geohasher.bbox(geohash)
-    polygon = Polygon([
-        (b['e'], b['n']), \
-        (b['w'], b['n']), \
-        (b['w'], b['s']), \
-        (b['e'], b['s']), \
-        (b['e'], b['n']) ])
     try:
-      countryPolygon = self.countrysPolygon[countryCode]
-      if not polygon.within(countryPolygon):
-        #multipoly = cascaded_union([countryPolygon, polygon])
-        multipoly = countryPolygon.union(polygon)
-        self.countrysPolygon[countryCode] = multipoly
+      self.countrysGeohashs[countryCode].add(geohash)
     except KeyError:
-      self.countrysPolygon[countryCode] = polygon
-    
-  def createKmlWrapper(self, networkLinkControl, name, style, innerKML):
-    return """<?xml version="1.0" encoding="UTF-8"?>
-<kml xmlns="http://www.opengis.net/kml/2.2">
-  %s
-  <Document> 
-    <name>%s</name>
-    %s
-    %s
-  </Document>
-</kml>""" % (networkLinkControl, name, style, innerKML)
+      self.countrysGeohashs[countryCode] = set([geohash])
+
+  def computeCountryExtents(self):
+    """ Computes the bounds of every country from its distinct 3-digit geohashs
+      in a single batched pass - they are all decoded at once. Unioning
+      polygons one 3-digit geohash at a time (with a "within" test for each)
+      grows quadratically as the country's multipolygon gets complex, and it's
+      only ever the bounds that are used - unless the true outlines are asked
+      for, in which case each country gets one union of all of its geohashs. """
+    stage = self.profiler.start("extents")
+    if self.outlines:
+      # Shapely (and GEOS) take a while to load, and are only needed for the
+      # outlines: http://toblerity.github.com/shapely/
+      from shapely.geometry import Polygon
+      from shapely.ops import unary_union
+    numGeohashs = 0
+    for countryCode in sorted(self.countrysGeohashs):
+      startMillis = int(round(time.time() * 1000))
+      usage = stageProfiler.Usage()
+      geohashs = self.countrysGeohashs[countryCode]
+      self.countrysBounds[countryCode] = self.bboxes().bounds(geohashs)
+      if self.outlines:
+        # In order, as the union's rings start wherever the polygons' order
+        # has them start - and the KML should be the same however the
+        # geohashs were found
+        polygons = []
+        (south, west, north, east) = decode(sorted(geohashs))
+        for (s, w, n, e) in zip(south.tolist(), west.tolist(), north.tolist(), \
+            east.tolist()):
+          polygons.append(Polygon([
+              (e, n), \
+              (w, n), \
+              (w, s), \
+              (e, s), \
+              (e, n) ]))
+        self.countrysPolygon[countryCode] = unary_union(polygons)
+      endMillis = int(round(time.time() * 1000))
+      print "%s: %d geohashs in %d millis" % (countryCode, len(geohashs), \
+          (endMillis - startMillis))
+      (wallSeconds, cpuSeconds) = usage.since()
+      stage.addCountry(countryCode, wallSeconds, cpuSeconds, len(geohashs))
+      numGeohashs = numGeohashs + len(geohashs)
+    stage.stop(items=numGeohashs)
+
+  def countryOutline(self, countryCode):
+    """ returns the KML LineStrings of the exterior rings of the country's true
+      outline, raising KeyError when the outlines were not computed """
+    multipoly = self.countrysPolygon[countryCode]
+    if hasattr(multipoly, "geoms"):
+      polygons = multipoly.geoms
+    else:
+      polygons = [multipoly]
+    lineStrings = []
+    for polygon in polygons:
+      coordinates = " ".join("%s,%s" % (x, y) for (x, y) in polygon.exterior.coords)
+      lineStrings.append(kmlWriter.LINE_STRING % coordinates)
+    return "\n".join(lineStrings)
 
   def geohashCoordinates(self, geohash, alt=0):
     """ Returns a string representing the coordinates of a geohash in a style
         suitable for using with Polygons, starting at the NE corner and moving
         in an anti-clockwise direction."""
     height = self.heightMultiplier * float(alt)
-    bbox = geohasher.bbox(geohash)
-    return """%s,%s,%d
-            %s,%s,%d
-            %s,%s,%d
-            %s,%s,%d
-            %s,%s,%d""" % ( \
+    bbox = self.bbox(geohash)
+    return kmlWriter.GEOHASH_COORDINATES % ( \
           bbox['e'], bbox['n'], height, \
           bbox['w'], bbox['n'], height, \
           bbox['w'], bbox['s'], height, \
           bbox['e'], bbox['s'], height, \
           bbox['e'], bbox['n'], height )
 
-  def innerCountryKML(self, countryCode, innerDir):
+  def innerCountryKML(self, countryCode, innerDir, lod=kmlWriter.DEFAULT_LOD):
     try:
-      multipoly = self.countrysPolygon[countryCode] 
-      bds = multipoly.bounds
+      bds = self.countrysBounds[countryCode]
       b = dict()
       b['w'] = str(bds[0])
       b['s'] = str(bds[1])
       b['e'] = str(bds[2])
       b['n'] = str(bds[3])
-      coordinates = "%s,%s %s,%s %s,%s %s,%s %s,%s" % \
-        (b['e'], b['n'], \
-        b['w'], b['n'], \
-        b['w'], b['s'], \
-        b['e'], b['s'], \
-        b['e'], b['n'])
+    except KeyError:
+      b = {'n': 0, 's': 0, 'e': 0, 'w': 0}
+    try:
       countryName = self.countryCodes[countryCode]
     except KeyError:
-      coordinates = "0,0 0,0 0,0" 
       countryName = "country #%s" % countryCode
-    return """
-  <NetworkLink>
-    <name>%s</name>
-    <Region>
-      <LatLonAltBox>
-        <north>%s</north>
-        <south>%s</south>
-        <east>%s</east>
-        <west>%s</west>
-      </LatLonAltBox>
-      <Lod>
-        <minLodPixels>32</minLodPixels>
-        <maxLodPixels>768</maxLodPixels>
-      </Lod>
-    </Region>
-    <Link>
-      <href>./%s/index.kml</href>
-      <viewRefreshMode>onRegion</viewRefreshMode>
-    </Link>
-   </NetworkLink>""" % (countryName, b['n'], b['s'], b['e'], b['w'], innerDir)
-
-  def innerGeohashKML(self, geohash, innerDir):
-    bbox = geohasher.bbox(geohash)
-    return """
-  <NetworkLink>
-    <name>%s</name>
-    <Region>
-      <LatLonAltBox>
-        <north>%s</north>
-        <south>%s</south>
-        <east>%s</east>
-        <west>%s</west>
-      </LatLonAltBox>
-      <Lod>
-        <minLodPixels>32</minLodPixels>
-        <maxLodPixels>768</maxLodPixels>
-      </Lod>
-    </Region>
-    <Link>
-      <href>./%s/index.kml</href>
-      <viewRefreshMode>onRegion</viewRefreshMode>
-    </Link>
-   </NetworkLink>""" % (geohash, bbox['n'], bbox['s'], bbox['e'], bbox['w'], innerDir)
-    
-  def writeGeohashKml(self, countryCode, geohash, innerGeohashs, innerPOIs, filename):
+    return kmlWriter.NETWORK_LINK % \
+        (countryName, b['n'], b['s'], b['e'], b['w'], lod, self.indexHref(innerDir))
+
+  def innerGeohashKML(self, geohash, innerDir, lod=kmlWriter.DEFAULT_LOD):
+    bbox = self.bbox(geohash)
+    return kmlWriter.NETWORK_LINK % \
+        (geohash, bbox['n'], bbox['s'], bbox['e'], bbox['w'], lod, \
+        self.indexHref(innerDir))
+
+  def innerLinkPixels(self, geohash, innerGeohashs, merged):
+    """ returns the dict of the minLodPixels of the NetworkLinks to the inner
+      geohashs (or countries) of a geohash, by name - empty unless the Lods are
+      tuned """
+    linkPixels = dict()
+    if self.lods is None:
+      return linkPixels
+    for innerGeohash in innerGeohashs:
+      name = innerGeohash["name"]
+      # The inner geohashs of a country are its 3-digit ones, and those of a
+      # geohash are one digit longer - or more, when the keys are collapsed
+      depth = 1
+      if geohash != "":
+        depth = len(name) - len(geohash)
+      linkPixels[name] = self.lods.linkPixels(innerGeohash["numPoi"], depth, \
+          name in merged)
+    return linkPixels
+
+  def innerLod(self, innerGeohash, linkPixels):
+    """ returns the Lod of the NetworkLink to an inner geohash (or country) """
+    if self.lods is None:
+      return kmlWriter.DEFAULT_LOD
+    return self.lods.linkLod(linkPixels[innerGeohash["name"]])
+
+  def indexHref(self, innerDir):
+    return "./%s/index.%s" % (innerDir, self.extension)
+
+  def writeGeohashKml(self, countryCode, geohash, innerGeohashs, innerPOIs, filename,
+      out=None):
     """ What's needed to build a geohash's KML? The following:
       1/ geohash being drawn. Usage:- to set the Camera and the LineRing (for
            outer border) in the NetworkLinkControl, and the name
@@ -270,6 +472,8 @@ class KmlBuilder:
       3/ innerPOIs found within this geohash. This is a list of tuples - the POI
          and whatever details are to be shown about the POI.
       4/ filename - to help understand whic KML file is actually on-screen.
+      The document is written to the file-like out, rather than to filename,
+      when there is one.
       Note that there is a similarity with what os.walk gives here - with the first
       three parameters - not initially on purpose, but it makes sense."""
     numPoi = 0
@@ -281,24 +485,23 @@ class KmlBuilder:
       numPoi = numPoi + innerGeohash["numPoi"]
     message = "%s has %d inner geohashs, %d direct POI and %d descendent POI" % (geohash, \
           len(innerGeohashs), len(innerPOIs), numPoi)
-    networkLinkControl = """  <NetworkLinkControl>
-     <!--<message>This is KML file %s</message>-->
-     <linkDescription><![CDATA[%s]]></linkDescription>
-    </NetworkLinkControl>""" % (filename, message)
-    # Note that the networkLinkControl could also have the following:
-    # <linkName>New KML features</linkName>
-    # <linkDescription><![CDATA[KML now has new features available!]]></linkDescription>
-    # TODO: add the Camera element to this.
+    # With tuned Lods, those of the inner geohashs' NetworkLinks are needed for
+    # that of the border
+    merged = set()
+    if self.lods is not None and countryCode != "":
+      merged = self.lods.merged(innerGeohashs)
+    linkPixels = self.innerLinkPixels(geohash, innerGeohashs, merged)
+    networkLinkControl = kmlWriter.NETWORK_LINK_CONTROL % (filename, message)
+    name = geohash
     if geohash == "":
       try:
-        multipoly = self.countrysPolygon[countryCode] 
-        bds = multipoly.bounds
+        bds = self.countrysBounds[countryCode]
         b = dict()
         b['w'] = str(bds[0])
         b['s'] = str(bds[1])
         b['e'] = str(bds[2])
         b['n'] = str(bds[3])
-        coordinates = "%s,%s %s,%s %s,%s %s,%s %s,%s" % \
+        coordinates = kmlWriter.BOX_COORDINATES % \
           (b['e'], b['n'], \
           b['w'], b['n'], \
           b['w'], b['s'], \
@@ -306,203 +509,872 @@ class KmlBuilder:
           b['e'], b['n'])
       except KeyError:
         coordinates = "0,0 0,0 0,0" 
-      outerBorder = """  <Placemark>
-      <name>%s outer bounding box</name>
-      <description>%s</description>
-      <styleUrl>#g0</styleUrl>
-        <LineString>
-          <extrude>0</extrude>
-          <tessellate>1</tessellate>
-          <coordinates>%s</coordinates>
-        </LineString>
-    </Placemark>""" % (countryName, message, coordinates)
+      outerBorder = kmlWriter.COUNTRY_BORDER % (countryName, message, coordinates)
+      try:
+        outerBorder = outerBorder + kmlWriter.COUNTRY_OUTLINE % \
+            (countryName, message, self.countryOutline(countryCode))
+      except KeyError:
+        pass
+      message = "%s has %d inner geohashs, and %d descendent POI" % \
+        (countryName, len(innerGeohashs), numPoi)
+      networkLinkControl = kmlWriter.COUNTRY_NETWORK_LINK_CONTROL % \
+        (filename, countryName, message)
+      name = countryCode
+      if countryCode == "":
+        filename = "%s/Nokia World POIs.%s" % (self.DATA_ROOT, self.extension)
     else:
       coordinates = self.geohashCoordinates(geohash, numPoi)
-      outerBorder = """  <Placemark>
-      <name>%s outer border</name>
-      <description>%s</description>
-      <styleUrl>#g%d</styleUrl>
-      <MultiGeometry>
-        <LineString>
-          <extrude>0</extrude>
-          <tessellate>1</tessellate>
-          <coordinates>%s</coordinates>
-        </LineString>
-        <Polygon>
-          <extrude>1</extrude>
-          <altitudeMode>relativeToGround</altitudeMode>
-          <outerBoundaryIs>
-            <LinearRing>
-              <coordinates>%s</coordinates>
-            </LinearRing>
-          </outerBoundaryIs>
-        </Polygon>
-      </MultiGeometry>
-    </Placemark>""" % (geohash, message, len(geohash), coordinates, coordinates)
-
-    style = """<Style id="g3">
-        <PolyStyle>
-          <color>281400FF</color>
-          <colorMode>normal</colorMode>
-          <fill>1</fill>
-        </PolyStyle>
-      </Style>
-      <Style id="g4">
-        <PolyStyle>
-          <color>2814B4FF</color>
-          <colorMode>normal</colorMode>
-          <fill>1</fill>
-        </PolyStyle>
-      </Style>
-      <Style id="g5">
-        <PolyStyle>
-          <color>1414F0FF</color>
-          <colorMode>normal</colorMode>
-          <fill>1</fill>
-        </PolyStyle>
-      </Style>"""
-
-    innerKML = outerBorder
+      region = ""
+      if self.lods is not None and innerGeohashs:
+        region = self.lods.borderRegion(geohash, self.bbox(geohash), linkPixels)
+      style = min(len(geohash), kmlWriter.MAX_STYLE_LEVEL)
+      outerBorder = kmlWriter.GEOHASH_BORDER % \
+          (geohash, message, style, region, coordinates, coordinates)
 
+    # The document is streamed out a fragment at a time, rather than built up
+    # as one (ever longer) string.
+    if out is None:
+      out = filename
+      self.filesWritten = self.filesWritten + 1
+    writer = kmlWriter.openKml(out, self.kmzLevel)
+    writer.begin(networkLinkControl, name)
+    writer.write(outerBorder)
     # If we're the very root - where countryCode == "" - then instead of writing
     # innerGeohashKML we need to write innerCountryKML
     for innerGeohash in innerGeohashs:
       igName = innerGeohash["name"]
       igDir = innerGeohash["dir"]
-      igNumPOI = innerGeohash["numPoi"]
+      lod = self.innerLod(innerGeohash, linkPixels)
       if countryCode == "":
-        innerGeohashKml = self.innerCountryKML(igName, igDir)
+        writer.write(self.innerCountryKML(igName, igDir, lod))
       else:
-        innerGeohashKml = self.innerGeohashKML(igName, igDir)
-      innerKML = "%s%s" % (innerKML, innerGeohashKml)
-    
-    if geohash == "": 
-      message = "%s has %d inner geohashs, and %d descendent POI" % \
-        (countryName, len(innerGeohashs), numPoi)
-      networkLinkControl = """  <NetworkLinkControl>
-     <!--<message>This is KML file %s</message>-->
-     <linkName>%s</linkName>
-     <linkDescription>%s</linkDescription>
-    </NetworkLinkControl>""" % (filename, countryName, message)
-      geohash = countryCode
-      if countryCode == "":
-        filename = "%s/Nokia World POIs.kml" % self.DATA_ROOT
-    # This enda the if geohash == ""
+        writer.write(self.innerGeohashKML(igName, igDir, lod))
+    if merged:
+      mergedGeohashs = [innerGeohash for innerGeohash in innerGeohashs \
+          if innerGeohash["name"] in merged]
+      writer.write(self.lods.mergedPlacemark(mergedGeohashs, \
+          [self.bbox(innerGeohash["name"]) for innerGeohash in mergedGeohashs], \
+          linkPixels))
+    if self.coordinates is not None and len(innerPOIs) > 0:
+      self.writePlacemarks(writer, geohash, innerPOIs)
+    writer.end()
+    writer.close()
 
-    kml = self.createKmlWrapper( networkLinkControl, geohash, style, innerKML )
-    f = open(filename, "w")
-    f.write(kml)
-    f.close()
+  def writePlacemarks(self, writer, geohash, ppids):
+    """ Writes a Placemark for each of the POI that there are coordinates for -
+      unless there are more than maxPlacemarks of them, in which case there's
+      just the one Placemark, in the middle of the geohash, with their number. """
+    if len(ppids) > self.maxPlacemarks:
+      bbox = self.bbox(geohash)
+      writer.write(kmlWriter.DENSE_PLACEMARK % (len(ppids), geohash, len(ppids), \
+          (bbox['e'] + bbox['w']) / 2, (bbox['n'] + bbox['s']) / 2))
+      return
+    from xml.sax.saxutils import escape
+    for (ppid, lat, lng, name) in self.coordinates.lookup( \
+        ppidRecords.toPpids(ppids)):
+      writer.write(kmlWriter.POI_PLACEMARK % (escape(name), ppid, lng, lat))
 
   def writeNumPOI(self, childPoi, dirname):
     f = open("%s/num.poi" % dirname, "w")
     f.write(str(childPoi))
     f.close()
 
-  def readNumPOI(self, childPoi, dirname):
-    try:
-      f = open("%s/num.poi" % dirname, "r")
-      poi = f.readline()
-      f.close()
-      childPoi = childPoi + int(poi)
-    except IOError:
-      pass
-    return childPoi
-
-  # The start: read the list of {ppid}s and add the appropriate content to the
-  # directories
-  def main(self):
-    print "Reading POI file ... ",
-    sys.stdout.flush()
+  def addPOIs(self, addPOI):
+    """ calls addPOI for every {ppid} line of the POI file (or stdin, gzip'ed
+      or bzip2'ed) as it is read, printing progress """
     startMillis = int(round(time.time() * 1000))
-    with open(self.poiFile, "r") as f:
-      content = f.readlines()
-    numPOI = len(content)
-    endMillis = int(round(time.time() * 1000))
-    print " read %d POI in %d millis. Adding geohash directories" \
-        % (numPOI, (endMillis - startMillis)),
+    stage = self.profiler.start("read")
+    filesWritten = self.filesWritten
+    stream = InputStream(self.poiFile)
     dotNum = 10000
-    print " (each dot is %d):" % dotDNum 
+    print " (each dot is %d):" % dotNum
     i = 0
-    for line in content:
+    for line in stream:
       if i % dotNum == 0:
         print ".",
         sys.stdout.flush()
       if i % (10* dotNum) == 0:
-        print " %d%% " % int(100 * i / numPOI),
+        print " %s " % stream.progress(),
         sys.stdout.flush()
-      countryCode, geohash = self.addToDirectory(line.rstrip('\n'))
-    print "\nAll POI added. Adding geohashs to countries:"
+      countryCode, geohash = addPOI(line.rstrip('\n'))
+      i = i + 1
+    stage.stop(items=i, files=self.filesWritten - filesWritten, \
+        bytes=stream.bytesRead)
+    endMillis = int(round(time.time() * 1000))
+    print "\nRead %d POI (%d bytes) in %d millis." \
+        % (i, stream.bytesRead, (endMillis - startMillis)),
+    return i
 
+  def addPOIChunks(self, addChunk, chunkSize=65536):
+    """ calls addChunk with each chunkSize lines of the POI file, as addPOIs
+      does with every line """
+    startMillis = int(round(time.time() * 1000))
+    stage = self.profiler.start("read")
+    filesWritten = self.filesWritten
+    stream = InputStream(self.poiFile)
+    print " (each dot is %d):" % chunkSize
+    lines = iter(stream)
     i = 0
-    pCC = ""
-    w = os.walk( self.DATA_ROOT, topdown=False )
-    try:
-      t3 = w.next() 
-      while True:
-        # t3 is (dirpath, dirnames, filenames)
-        (dirpath, dirnames, filenames) = t3
-        countryCode, geohash = self.dirnameToCountryCodeGeohash(dirpath)
-        if pCC != countryCode:
-          print "%s (%d%%)" % (countryCode, int(100 * i / numPOI)),
-          sys.stdout.flush()
-          pCC = countryCode
-        # this is the _real_ work of this portion!
-        self.addGeohashToCountry(countryCode, geohash)
-        i = i + 1
-        t3 = w.next()
-    except StopIteration:
-      pass
+    for chunk in iter(lambda: list(itertools.islice(lines, chunkSize)), []):
+      print ".",
+      sys.stdout.flush()
+      if (i / chunkSize) % 10 == 0:
+        print " %s " % stream.progress(),
+        sys.stdout.flush()
+      addChunk(chunk)
+      i = i + len(chunk)
+    stage.stop(items=i, files=self.filesWritten - filesWritten, \
+        bytes=stream.bytesRead)
+    endMillis = int(round(time.time() * 1000))
+    print "\nRead %d POI (%d bytes) in %d millis." \
+        % (i, stream.bytesRead, (endMillis - startMillis)),
+    return i
 
+  def writeTrieKml(self, trie):
+    """ The in-memory equivalent of the two os.walk passes of main(): every node
+      of the trie is one of the directories that would have been created, and
+      it is visited children-first so that the descendent counts are known. """
+    self.addTrieToCountries(trie)
     print "\nAll geohashs added. Building KML:"
+    return self.writeKml()
+
+  def adaptTrie(self, trie):
+    """ adapts the trie to the density of its POI, when asked to """
+    if self.adaptivePoi is None:
+      return
+    stage = self.profiler.start("adapt")
+    numSplit = trie.adapt(self.adaptivePoi, self.locateGeohashs, \
+        self.ADAPTIVE_MAX_LENGTH)
+    stage.stop(items=trie.root.numPoi, split=numSplit)
+    print "\nSplit %d geohashs with more than %d POI" % (numSplit, self.adaptivePoi),
+
+  def locateGeohashs(self, ppids, length):
+    """ returns the (n, length) uint8 array of the characters of the geohashs
+      of the ppids' coordinates, rows of zeros for those without any """
+    chars = numpy.zeros((len(ppids), length), dtype=numpy.uint8)
+    if self.coordinates is not None:
+      (found, lats, lngs) = self.coordinates.locate(ppidRecords.toPpids(ppids))
+      chars[found] = encode(lats[found], lngs[found], length)
+    return chars
+
+  def addTrieToCountries(self, trie):
+    print "\nAll POI added. Adding geohashs to countries:"
+    stage = self.profiler.start("countries")
+    numGeohashs = 0
+    for countryCode, countryNode in trie.countries():
+      print countryCode,
+      sys.stdout.flush()
+      for geohash in countryNode.children:
+        self.addGeohashToCountry(countryCode, geohash)
+      numGeohashs = numGeohashs + len(countryNode.children)
+    stage.stop(items=numGeohashs)
+    print "\nComputing country extents:"
+    self.computeCountryExtents()
 
-    # The thing to do is to walk the filesystem
-    w = os.walk( self.DATA_ROOT, topdown=False )
+  def writeTrieNodeKml(self, path, node, out=None):
+    """ writes the index.kml of one node of the trie - to the file-like out,
+      when there is one - returning its number of descendent POI """
+    dirpath = self.pathToDirname(path)
+    countryCode, geohash = self.dirnameToCountryCodeGeohash(dirpath)
+    innerGeohashs = []
+    children = node.children
+    for key in sorted(children):
+      innerGeohash = dict()
+      innerGeohash["name"] = "%s%s" % (geohash, key)
+      innerGeohash["dir"] = key
+      innerGeohash["numPoi"] = children[key].numPoi
+      innerGeohashs.append(innerGeohash)
+    kmlFilename = "%s/index.%s" % (dirpath, self.extension)
+    if out is None:
+      self.makeDirectory(dirpath)
+      if self.numPoiFiles:
+        self.writeNumPOI(node.numPoi, dirpath)
+    self.writeGeohashKml(countryCode, geohash, innerGeohashs, node.ppids, \
+        kmlFilename, out)
+    return node.numPoi
 
-    pGeohash = "" # <- this is used for progress printing ...
-    # take a look at http://docs.python.org/library/os.html
+  def writeDirectoryKml(self, dirpath, dirnames, filenames):
+    """ writes the index.kml and num.poi of one directory from what os.walk
+      gives for it, returning its number of descendent POI """
+    # OK: so we need the geohash - not all dirs have geohashs - remember the
+    # country codes and the root dir! 
+    countryCode, geohash = self.dirnameToCountryCodeGeohash(dirpath)
+
+    # How many of the files are "POI" {ppid}s? Unlike the index.kml and
+    # num.poi, they all have a "-" - whatever the length of their geohash, so
+    # that the counts are those of the trie builds. Note that this number does
+    # not include the decendents!
+    innerGeohashs = []
+    innerPOIs = []
+    for filename in filenames:
+      if "-" in filename:
+        innerPOIs.append(filename)
+    cell = countryCode + geohash
+    for dirname in sorted(dirnames):
+      innerGeohash = dict()
+      innerGeohash["name"] = "%s%s" % (geohash, dirname)
+      innerGeohash["dir"] = dirname
+      innerGeohash["numPoi"] = self.cellCounts.get(cell + dirname, 0)
+      innerGeohashs.append(innerGeohash)
+    childPoi = self.cellCounts.get(cell, 0)
+
+    kmlFilename = "%s/index.%s" % (dirpath, self.extension)
+    if self.numPoiFiles:
+      self.writeNumPOI(childPoi, dirpath)
+    self.writeGeohashKml(countryCode, geohash, innerGeohashs, innerPOIs, kmlFilename)
+    return childPoi
+
+  def shards(self):
+    """ Splits the KML below the country level into independent shards of
+      (countryCode, [3-digit geohashs]): a shard per country, other than for the
+      countries with more than their share of the 3-digit geohashs, which get
+      a shard per 3-digit geohash so that no one worker is left with them. """
+    numGeohashs = sum(len(geohashs) for geohashs in self.countrysGeohashs.values())
+    share = max(1, numGeohashs / self.workers)
+    shards = []
+    for countryCode in sorted(self.countrysGeohashs):
+      geohashs = sorted(self.countrysGeohashs[countryCode])
+      if self.workers > 1 and len(geohashs) > share:
+        for geohash in geohashs:
+          shards.append((countryCode, [geohash]))
+      else:
+        shards.append((countryCode, geohashs))
+    # The biggest first, so that they're not the stragglers
+    shards.sort(key=lambda shard: len(shard[1]), reverse=True)
+    return shards
+
+  def writeShardKml(self, countryCode, geohashs):
+    """ writes all of the KML below the country's 3-digit geohashs, returning
+      the number of POI in them """
+    numPoi = 0
+    # The children of a HierarchyIndex's node are read anew each time they
+    # are asked for, so they are only asked for the once
+    if self.trie is not None:
+      countrysChildren = self.trie.root.children[countryCode].children
+    for geohash in geohashs:
+      if self.trie is not None:
+        node = countrysChildren[geohash]
+        for path, n in self.trie.walk(node, (countryCode, geohash)):
+          self.writeTrieNodeKml(path, n)
+        numPoi = numPoi + node.numPoi
+      else:
+        top = self.pathToDirname((countryCode, geohash))
+        for (dirpath, dirnames, filenames) in os.walk(top):
+          self.writeDirectoryKml(dirpath, dirnames, filenames)
+        numPoi = numPoi + self.cellCounts.get(countryCode + geohash, 0)
+    return numPoi
+
+  def writeKml(self):
+    """ Writes the KML of every shard - in parallel when there is more than one
+      worker - and then, once their totals are known, the KML of the countries
+      and the root. """
+    global poolBuilder
+    poolBuilder = self
+    stage = self.profiler.start("write")
+    shards = self.shards()
+    pool = None
+    if self.workers > 1:
+      import multiprocessing
+      # The workers are forked with the bbox table, rather than each building
+      # its own
+      self.bboxes()
+      pool = multiprocessing.Pool(self.workers)
+      results = pool.imap_unordered(writeShardKml, shards)
+    else:
+      results = itertools.imap(writeShardKml, shards)
+    countrysShards = dict()
+    for (countryCode, geohashs) in shards:
+      countrysShards[countryCode] = countrysShards.get(countryCode, 0) + 1
+    countrysNumPoi = dict()
+    # The shards may be written by the workers, so they report what they wrote
+    files = 0
+    for (countryCode, geohashs), numPoi, (wallSeconds, cpuSeconds, shardFiles) \
+        in results:
+      stage.addCountry(countryCode, wallSeconds, cpuSeconds, numPoi, shardFiles)
+      files = files + shardFiles
+      countrysNumPoi[countryCode] = countrysNumPoi.get(countryCode, 0) + numPoi
+      countrysShards[countryCode] = countrysShards[countryCode] - 1
+      if countrysShards[countryCode] == 0:
+        print "%s (%d POI)" % (countryCode, countrysNumPoi[countryCode]),
+        sys.stdout.flush()
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+    filesWritten = self.filesWritten
+    if self.trie is not None:
+      for countryCode, countryNode in self.trie.countries():
+        self.writeTrieNodeKml((countryCode,), countryNode)
+      self.writeTrieNodeKml((), self.trie.root)
+    else:
+      for countryCode in sorted(countrysNumPoi):
+        dirpath = self.pathToDirname((countryCode,))
+        self.writeDirectoryKml(dirpath, sorted(self.countrysGeohashs[countryCode]), \
+            os.listdir(dirpath))
+      # There's no data root yet when there were no POI to add to it
+      self.makeDirectory(self.DATA_ROOT)
+      self.writeDirectoryKml(self.DATA_ROOT, sorted(countrysNumPoi), [])
+    files = files + self.filesWritten - filesWritten
+    stage.stop(items=sum(countrysNumPoi.values()), files=files)
+    print
+    return 0
+
+  def mainInMemory(self):
+    print "Adding POI to the geohash trie",
+    self.addPOIs(self.trie.add)
+    self.adaptTrie(self.trie)
+    result = self.writeTrieKml(self.trie)
+    self.saveIndex()
+    return result
+
+  def mainCompact(self):
+    self.addCompactPOIs()
+    self.adaptTrie(self.trie)
+    result = self.writeTrieKml(self.trie)
+    self.saveIndex()
+    return result
+
+  def addCompactPOIs(self):
+    print "Packing POI",
+    records = ppidRecords.PpidRecords()
+    self.addPOIChunks(records.add)
+    startMillis = int(round(time.time() * 1000))
+    stage = self.profiler.start("sort")
+    records.sort()
+    numCells = 0
+    for (cell, cellRecords) in records.cells():
+      self.trie.addCell(cell, cellRecords)
+      numCells = numCells + 1
+    stage.stop(items=len(records), cells=numCells)
+    endMillis = int(round(time.time() * 1000))
+    print "\n%d POI (%dMB packed, %d not ppids) in %d cells, sorted and added " \
+        "to the geohash trie in %d millis" % (len(records), \
+        records.records.nbytes >> 20, records.rejected, numCells, \
+        (endMillis - startMillis)),
+
+  def applyDelta(self, deltaFile):
+    """ Applies a delta - lines of +{ppid} to add and -{ppid} to remove (a bare
+      {ppid} is added) - to the trie. """
+    stage = self.profiler.start("delta")
+    added = 0
+    removed = 0
+    for line in InputStream(deltaFile):
+      line = line.rstrip('\n')
+      if line.startswith("-"):
+        if self.trie.remove(line[1:]):
+          removed = removed + 1
+      elif line != "":
+        if line.startswith("+"):
+          line = line[1:]
+        self.trie.add(line)
+        added = added + 1
+    stage.stop(items=added + removed)
+    print "Delta added %d and removed %d POI" % (added, removed)
+
+  def mainIncremental(self):
+    """ Rewrites only the KML of the cells whose POI have changed since the last
+      incremental build - the changed cells and all of their ancestors. What
+      has changed is found by comparing the cell hashes of the manifest saved
+      by that build (see manifest.py) with those of this one. When that build
+      had other rendering options, all of the KML is rewritten. """
+    import manifest
+    manifestFile = "%s/manifest.gz" % self.DATA_ROOT
+    if self.deltaFile is None:
+      print "Adding POI to the geohash trie",
+      self.addPOIs(self.trie.add)
+      (oldHashes, oldOptions) = manifest.load(manifestFile)
+    else:
+      print "Loading the manifest and applying the delta"
+      (oldHashes, oldOptions) = manifest.load(manifestFile, self.trie)
+      self.applyDelta(self.deltaFile)
+    newHashes = manifest.cellHashes(self.trie)
+    options = self.renderingOptions()
+    # Every cell has changed, as far as its KML is concerned
+    rewriteAll = len(oldHashes) > 0 and oldOptions != options
+    if rewriteAll:
+      print "\nThe rendering options have changed, so all of the KML is rewritten"
+
+    print "\nAdding geohashs to countries:"
+    stage = self.profiler.start("countries")
+    numGeohashs = 0
+    for countryCode, countryNode in self.trie.countries():
+      for geohash in countryNode.children:
+        self.addGeohashToCountry(countryCode, geohash)
+      numGeohashs = numGeohashs + len(countryNode.children)
+    stage.stop(items=numGeohashs)
+    self.computeCountryExtents()
+
+    print "\nRemoving the cells that have no POI left:"
+    numRemoved = 0
+    for cell in sorted(oldHashes):
+      if cell not in newHashes:
+        shutil.rmtree(self.cellToDirname(cell), ignore_errors=True)
+        numRemoved = numRemoved + 1
+
+    print "Building the KML of the changed cells:"
+    stage = self.profiler.start("write")
+    filesWritten = self.filesWritten
+    numWritten = 0
+    for path, node in self.trie.walk():
+      cell = "".join(path)
+      if rewriteAll or oldHashes.get(cell) != newHashes[cell]:
+        self.writeTrieNodeKml(path, node)
+        numWritten = numWritten + 1
+    stage.stop(items=numWritten, files=self.filesWritten - filesWritten, \
+        cells=len(newHashes), removed=numRemoved)
+    manifest.save(manifestFile, self.trie, newHashes, options)
+    print "Wrote the KML of the %d changed of %d cells, removed %d cells" % \
+        (numWritten, len(newHashes), numRemoved)
+    self.saveIndex()
+    return 0
+
+  def renderingOptions(self):
+    """ returns the dict of the options the KML is written with, as strings -
+      those an incremental build's manifest is saved with """
+    coordinates = None
+    if self.coordinatesFile is not None:
+      # The file's size and time too, as it may have changed since
+      stat = os.stat(self.coordinatesFile)
+      coordinates = "%s:%d:%d" % (os.path.abspath(self.coordinatesFile), \
+          stat.st_size, int(stat.st_mtime))
+    mergePoi = None
+    if self.lods is not None:
+      mergePoi = self.lods.mergePoi
+    options = dict(extension=self.extension, kmzLevel=self.kmzLevel,
+        coordinates=coordinates, maxPlacemarks=self.maxPlacemarks,
+        outlines=self.outlines, heightMultiplier=self.heightMultiplier,
+        numPoiFiles=self.numPoiFiles, adaptivePoi=self.adaptivePoi,
+        lod=self.lods is not None, mergePoi=mergePoi)
+    return dict((name, str(value)) for (name, value) in options.iteritems())
+
+  def saveIndex(self):
+    """ writes the index of the trie's hierarchy, when asked to """
+    if not self.indexHierarchy:
+      return
+    startMillis = int(round(time.time() * 1000))
+    stage = self.profiler.start("index")
+    import hierarchyIndex
+    hierarchyIndex.save(self.DATA_ROOT, self.trie, self.countrysBounds)
+    stage.stop(items=self.trie.root.numPoi, files=2)
+    endMillis = int(round(time.time() * 1000))
+    print "Wrote the hierarchy index in %d millis" % (endMillis - startMillis)
+
+  def mainRender(self):
+    """ Writes all of the KML again from the hierarchy index of an earlier
+      build, rather than from the POI """
+    print "Rendering the hierarchy index in %s" % self.DATA_ROOT
+    self.loadIndex()
+    print "Building KML:"
+    return self.writeKml()
+
+  def loadIndex(self):
+    """ reads the hierarchy - and the countries' extents - from the index of an
+      earlier build """
+    stage = self.profiler.start("load")
+    import hierarchyIndex
+    self.trie = hierarchyIndex.HierarchyIndex(self.DATA_ROOT)
+    numGeohashs = 0
+    for countryCode, countryNode in self.trie.countries():
+      # (read from the index each time they're asked for)
+      geohashs = countryNode.children
+      for geohash in geohashs:
+        self.addGeohashToCountry(countryCode, geohash)
+      numGeohashs = numGeohashs + len(geohashs)
+    stage.stop(items=numGeohashs)
+    # The index has the countries' extents, but not their outlines
+    if self.outlines:
+      print "Computing country extents:"
+      self.computeCountryExtents()
+    else:
+      self.countrysBounds = self.trie.countrysBounds()
+
+  def renderDocument(self, urlPath):
+    """ Renders the document of a URL path - the same as the file of that path
+      under the data root, with "/" being the root document - for
+      tileServer. Returns the (document, content type), or None when there is
+      no such document. """
+    keys = [key for key in urlPath.split("/") if key != ""]
+    rootName = "Nokia World POIs.%s" % self.extension
+    if keys == [rootName]:
+      keys = []
+    elif keys and keys[-1] == "index.%s" % self.extension:
+      keys = keys[:-1]
+      if not keys:
+        return None
+    elif keys:
+      return None
+    node = self.trie.root
+    for key in keys:
+      node = node.children.get(key)
+      if node is None:
+        return None
+    # As for writeKml, only the 3-digit geohashs (and below) are drawn
+    if len(keys) > 1 and len(keys[1]) != 3:
+      return None
+    out = kmlWriter.KmlBuffer()
+    self.writeTrieNodeKml(tuple(keys), node, out)
+    return out.getvalue(), self.contentType
+
+  def mainServe(self):
+    """ Serves the KML, rendering each document as it's asked for, from the
+      POI file when there is one and otherwise from the hierarchy index of an
+      earlier build """
+    if self.poiFile is None:
+      print "Serving the hierarchy index in %s" % self.DATA_ROOT
+      self.loadIndex()
+    else:
+      if self.compact:
+        self.addCompactPOIs()
+      else:
+        print "Adding POI to the geohash trie",
+        self.addPOIs(self.trie.add)
+      self.adaptTrie(self.trie)
+      self.addTrieToCountries(self.trie)
+      print
+    import tileServer
+    self.contentType = tileServer.CONTENT_TYPES[self.extension]
+    tileServer.serve(self.renderDocument, self.servePort, \
+        cacheSize=self.serveCacheSize)
+    return 0
+
+  # The start: read the list of {ppid}s and add the appropriate content to the
+  # directories
+  def spillPOI(self, ppid):
+    """ buffers the ppid for the spill file of its {cc:3}{gh:3} partition,
+      writing all of the buffers out when they are full """
+    path = self.trie.ppidToPath(ppid)
+    if path is None:
+      return None, None
+    key = "".join(path[:2])
+    # The key names a file, so only the usual digits and letters will do
+    if not key.isalnum():
+      return None, None
     try:
-      t3 = w.next() 
-      while True:
-        # t3 is (dirpath, dirnames, filenames)
-        (dirpath, dirnames, filenames) = t3
-
-        # OK: so we need the geohash - not all dirs have geohashs - remember the
-        # country codes and the root dir! 
-        countryCode, geohash = self.dirnameToCountryCodeGeohash(dirpath)
-        
-        if len(geohash) > 2:
-          print "\b" * (2 + len(pGeohash)),
-          print geohash,
-          pGeohash = geohash
-          sys.stdout.flush()
-
-
-        # How many of the files are "POI" {ppid}s? POI have a given length. Note
-        # that this number does not include the decendents!
-        innerGeohashs = []
-        innerPOIs = []
-        for filename in filenames:
-          if len(filename) == 41:
-            innerPOIs.append(filename)
-        childPoi = len(innerPOIs)
-        for dirname in dirnames:
-          innerGeohash = dict()
-          innerGeohash["name"] = "%s%s" % (geohash, dirname)
-          innerGeohash["dir"] = dirname
-          childPoi = self.readNumPOI(childPoi, os.path.join(dirpath, dirname))
-          innerGeohash["numPoi"] = childPoi
-          innerGeohashs.append(innerGeohash)
-          
-        kmlFilename = "%s/index.kml"% dirpath
-        self.writeNumPOI(childPoi, dirpath)
-        self.writeGeohashKml(countryCode, geohash, innerGeohashs, innerPOIs, kmlFilename)
-        t3 = w.next()
-    except StopIteration:   
-      pass
+      self.spillBuffers[key].append(ppid)
+    except KeyError:
+      self.spillBuffers[key] = [ppid]
+    self.spillBuffered = self.spillBuffered + 1
+    if self.spillBuffered >= self.SPILL_BUFFER:
+      self.flushSpillBuffers()
+    return key[:3], key[3:6]
+
+  def flushSpillBuffers(self):
+    for key in self.spillBuffers:
+      f = open("%s/%s.txt" % (self.spillPartitions, key), "ab")
+      f.write("\n".join(self.spillBuffers[key]))
+      f.write("\n")
+      f.close()
+    self.spillBuffers = dict()
+    self.spillBuffered = 0
+
+  def writeSpillPartitionKml(self, key):
+    """ writes all of the KML of a spilled {cc:3}{gh:3} partition, from a trie
+      of just its ppids, returning the partition's (path, numPoi, ppids,
+      indexRows) - the ppids being those left above its 3-digit geohash, which
+      there are only for the rare ppids without one. With --index, the index
+      block of the partition is written next to it, indexRows being its
+      number of rows. """
+    if self.indexHierarchy:
+      import hierarchyIndex
+    trie = GeohashTrie()
+    for line in open("%s/%s.txt" % (self.spillPartitions, key), "rb"):
+      trie.add(line.rstrip('\n'))
+    # Each partition is a whole 3-digit geohash, and so can be adapted alone
+    if self.adaptivePoi is not None:
+      trie.adapt(self.adaptivePoi, self.locateGeohashs, self.ADAPTIVE_MAX_LENGTH)
+    results = []
+    for countryCode, countryNode in trie.countries():
+      for geohash in sorted(countryNode.children):
+        node = countryNode.children[geohash]
+        # As for writeKml, only the 3-digit geohashs are drawn
+        if len(geohash) == 3:
+          for path, n in trie.walk(node, (countryCode, geohash)):
+            self.writeTrieNodeKml(path, n)
+        indexRows = 0
+        if self.indexHierarchy:
+          f = open("%s/%s.ppids" % (self.spillPartitions, key), "wb")
+          rows = hierarchyIndex.subtreeRows(countryCode + geohash, node, f)
+          f.close()
+          numpy.save("%s/%s.npy" % (self.spillPartitions, key), rows)
+          indexRows = len(rows)
+        results.append(((countryCode, geohash), node.numPoi, [], indexRows))
+      if countryNode.ppids:
+        results.append(((countryCode,), len(countryNode.ppids), \
+            countryNode.ppids, 0))
+    return results
+
+  def saveSpillIndex(self, indexBlocks):
+    """ writes the hierarchy index from the skeleton trie and the index blocks
+      the partitions left in the spill directory """
+    startMillis = int(round(time.time() * 1000))
+    stage = self.profiler.start("index")
+    blockSizes = dict()
+    for block in indexBlocks:
+      blockSizes[block] = indexBlocks[block][1]
+    import hierarchyIndex
+    writer = hierarchyIndex.IndexWriter(self.DATA_ROOT, self.trie, blockSizes)
+    for ((countryCode, geohash), (key, indexRows)) in indexBlocks.iteritems():
+      rows = numpy.load("%s/%s.npy" % (self.spillPartitions, key))
+      ppidOffset = writer.ppids.tell()
+      f = open("%s/%s.ppids" % (self.spillPartitions, key), "rb")
+      shutil.copyfileobj(f, writer.ppids)
+      f.close()
+      writer.addBlock(countryCode, geohash, rows, ppidOffset)
+    writer.close(self.countrysBounds)
+    stage.stop(items=self.trie.root.numPoi, files=2)
+    endMillis = int(round(time.time() * 1000))
+    print "Wrote the hierarchy index in %d millis" % (endMillis - startMillis)
+
+  def mainSpill(self):
+    """ Builds the KML one spilled {cc:3}{gh:3} partition at a time (in
+      parallel when there is more than one worker), the biggest first, and
+      then that of the countries and the root from a trie of just the 3-digit
+      geohashs' counts. """
+    import tempfile
+    self.spillPartitions = tempfile.mkdtemp(prefix="spill-", dir=self.spillDir)
+    self.spillBuffers = dict()
+    self.spillBuffered = 0
+    try:
+      print "Partitioning POI into %s" % self.spillPartitions,
+      self.addPOIs(self.spillPOI)
+      self.flushSpillBuffers()
+      partitions = []
+      for filename in os.listdir(self.spillPartitions):
+        size = os.path.getsize("%s/%s" % (self.spillPartitions, filename))
+        partitions.append((size, filename[:-len(".txt")]))
+      partitions.sort(reverse=True)
+      keys = [key for (size, key) in partitions]
+
+      print "\n%d partitions, the largest of %d bytes. Adding geohashs to " \
+          "countries:" % (len(keys), partitions[0][0] if partitions else 0)
+      stage = self.profiler.start("countries")
+      for key in sorted(keys):
+        if len(key) > 3:
+          self.addGeohashToCountry(key[:3], key[3:])
+      stage.stop(items=len(keys))
+      print "\nComputing country extents:"
+      self.computeCountryExtents()
+
+      print "\nAll geohashs added. Building KML:"
+      global poolBuilder
+      poolBuilder = self
+      stage = self.profiler.start("write")
+      pool = None
+      if self.workers > 1:
+        import multiprocessing
+        # (As for writeKml, the workers share the one bbox table)
+        self.bboxes()
+        pool = multiprocessing.Pool(self.workers)
+        results = pool.imap_unordered(writeSpillPartitionKml, keys)
+      else:
+        results = itertools.imap(writeSpillPartitionKml, keys)
+      trie = self.trie
+      # Each index block is the partition's, (countryCode, geohash): key
+      indexBlocks = dict()
+      files = 0
+      for (key, partitionResults, (wallSeconds, cpuSeconds, partitionFiles)) \
+          in results:
+        stage.addCountry(key[:3], wallSeconds, cpuSeconds, \
+            sum(result[1] for result in partitionResults), partitionFiles)
+        files = files + partitionFiles
+        for (path, numPoi, ppids, indexRows) in partitionResults:
+          if indexRows:
+            indexBlocks[path] = (key, indexRows)
+          node = trie.root
+          node.numPoi = node.numPoi + numPoi
+          for k in path:
+            try:
+              node = node.children[k]
+            except KeyError:
+              node.children[k] = GeohashNode()
+              node = node.children[k]
+            node.numPoi = node.numPoi + numPoi
+          node.ppids.extend(ppids)
+        print "%s" % key,
+        sys.stdout.flush()
+      if pool is not None:
+        pool.close()
+        pool.join()
+      filesWritten = self.filesWritten
+      for countryCode, countryNode in trie.countries():
+        self.writeTrieNodeKml((countryCode,), countryNode)
+      self.writeTrieNodeKml((), trie.root)
+      files = files + self.filesWritten - filesWritten
+      stage.stop(items=trie.root.numPoi, files=files, partitions=len(keys))
+      print
+      if self.indexHierarchy:
+        self.saveSpillIndex(indexBlocks)
+    finally:
+      shutil.rmtree(self.spillPartitions)
     return 0
 
+  def main(self):
+    mainMode = self.mainMode()
+    result = mainMode()
+    if self.profileFile is not None:
+      self.profiler.save(self.profileFile, mode=mainMode.__name__, \
+          poiFile=self.poiFile, deltaFile=self.deltaFile, workers=self.workers, \
+          extension=self.extension, coordinates=self.coordinates is not None, \
+          outlines=self.outlines)
+      print "Wrote the profile to %s" % self.profileFile
+    return result
+
+  def mainMode(self):
+    """ returns the main method of the build that was asked for """
+    if self.servePort is not None:
+      return self.mainServe
+    if self.render:
+      return self.mainRender
+    if self.incremental:
+      return self.mainIncremental
+    if self.spillDir is not None:
+      return self.mainSpill
+    if self.compact:
+      return self.mainCompact
+    if self.trie is not None:
+      return self.mainInMemory
+    return self.mainDirectory
+
+  def mainDirectory(self):
+    print "Adding geohash directories",
+    self.addPOIs(self.addToDirectory)
+    self.aggregateCounts()
+    print "\nAll POI added. Adding geohashs to countries:"
+
+    # The 3-digit geohash directories are all known from the counts, so there
+    # is no need to walk the filesystem to find them.
+    stage = self.profiler.start("countries")
+    pCC = ""
+    for cell in sorted(self.cellCounts):
+      countryCode, geohash = cell[:3], cell[3:]
+      if pCC != countryCode:
+        print countryCode,
+        sys.stdout.flush()
+        pCC = countryCode
+      self.addGeohashToCountry(countryCode, geohash)
+    stage.stop(items=sum(len(geohashs) for geohashs in \
+        self.countrysGeohashs.values()))
+    print "\nComputing country extents:"
+    self.computeCountryExtents()
+
+    print "\nAll geohashs added. Building KML:"
+    return self.writeKml()
+
+# The pool's workers are forked from the builder, and so inherit it - along with
+# its trie - rather than having it pickled to them.
+poolBuilder = None
+
+# Each also returns the (wall seconds, CPU seconds, files) it took, for the
+# profile of the stage.
+
+def writeShardKml(shard):
+  (countryCode, geohashs) = shard
+  usage = stageProfiler.Usage()
+  filesWritten = poolBuilder.filesWritten
+  numPoi = poolBuilder.writeShardKml(countryCode, geohashs)
+  return shard, numPoi, usage.since() + (poolBuilder.filesWritten - filesWritten,)
+
+def writeSpillPartitionKml(key):
+  usage = stageProfiler.Usage()
+  filesWritten = poolBuilder.filesWritten
+  results = poolBuilder.writeSpillPartitionKml(key)
+  return key, results, usage.since() + (poolBuilder.filesWritten - filesWritten,)
+
 if __name__ == "__main__":
-  kb = KmlBuilder(sys.argv[1])
+  parser = argparse.ArgumentParser(
+      description="Builds a hierarchy of KML files of POI by country and geohash")
+  parser.add_argument("poiFile", nargs="?",
+      help="file with one {ppid} per line, may be gzip'ed or bzip2'ed, - for stdin")
+  parser.add_argument("--in-memory", action="store_true",
+      help="build the country/geohash hierarchy in memory rather than as one "
+      "file per POI under %s" % KmlBuilder.DATA_ROOT)
+  parser.add_argument("--bbox-table", metavar="FILE",
+      help="memory-map the table of 1 to 5 digit geohash bboxes from FILE, "
+      "building it there first if need be")
+  parser.add_argument("--outlines", action="store_true",
+      help="also draw the true outline of each country's 3-digit geohashs")
+  parser.add_argument("--workers", type=int, default=1, metavar="N",
+      help="write the KML of the countries (or, for the largest, of their "
+      "3-digit geohashs) in N processes")
+  parser.add_argument("--incremental", action="store_true",
+      help="only rewrite the KML of the cells whose POI changed since the last "
+      "incremental build, using the manifest it left in %s" % KmlBuilder.DATA_ROOT)
+  parser.add_argument("--delta", metavar="FILE",
+      help="incrementally apply FILE's +{ppid}/-{ppid} lines to the last "
+      "incremental build instead of reading a whole POI file")
+  parser.add_argument("--num-poi", action="store_true",
+      help="also write each directory's descendent POI count to its num.poi, "
+      "as earlier builds did")
+  parser.add_argument("--kmz", type=int, nargs="?", const=6, metavar="LEVEL",
+      help="write every document as a KMZ, compressed at zlib LEVEL (0-9, "
+      "default 6)")
+  parser.add_argument("--coordinates", metavar="FILE",
+      help="draw the POI of the 5-digit geohashs as Placemarks, from FILE's "
+      "{ppid},{lat},{lng},{name} lines")
+  parser.add_argument("--max-placemarks", type=int, default=500, metavar="N",
+      help="geohashs with more than N POI get one Placemark with their number "
+      "rather than one per POI")
+  parser.add_argument("--compact", action="store_true",
+      help="build in memory, holding the ppids as packed 24-byte records "
+      "rather than strings (only ppids of the usual form are kept)")
+  parser.add_argument("--spill", metavar="DIR",
+      help="for POI files bigger than memory: partition the POI by country and "
+      "3-digit geohash into spill files under DIR, and build from one "
+      "partition at a time")
+  parser.add_argument("--index", action="store_true",
+      help="also write a binary index of the hierarchy to %s, for --render "
+      "(needs --in-memory, --compact, --incremental or --spill)" \
+      % KmlBuilder.DATA_ROOT)
+  parser.add_argument("--render", action="store_true",
+      help="only write the KML again, from the index of an earlier --index "
+      "build - no POI file is read")
+  parser.add_argument("--serve", type=int, metavar="PORT",
+      help="rather than writing the KML, serve it on localhost:PORT, rendering "
+      "it as it is asked for - from the POI file, or else from the index of an "
+      "earlier --index build")
+  parser.add_argument("--serve-cache", type=int, default=10000, metavar="N",
+      help="keep the N most recently served documents")
+  parser.add_argument("--adaptive", type=int, metavar="N",
+      help="split the geohashs with more than N POI into deeper ones (by the "
+      "POI's --coordinates), and skip the cells with just the one inner "
+      "geohash (needs --in-memory, --compact, --spill or --serve)")
+  parser.add_argument("--lod", action="store_true",
+      help="tune the Lod of each region to the size of its geohash and the "
+      "density of its POI, rather than 32/768 pixels for all")
+  parser.add_argument("--merge-poi", type=int, metavar="N",
+      help="with tuned Lods, draw the inner geohashs of no more than N POI as "
+      "one Placemark until they are close enough in to be fetched")
+  parser.add_argument("--profile", metavar="FILE",
+      help="write the wall & CPU time, peak RSS, items & files of each stage "
+      "of the build (and of each country, where it goes a country at a time) "
+      "to FILE as JSON")
+  parser.add_argument("--cprofile", metavar="FILE",
+      help="run the --cprofile-stage stage under cProfile, dumping its stats to "
+      "FILE")
+  parser.add_argument("--cprofile-stage", default="read", metavar="STAGE",
+      help="the stage to run under cProfile: coordinates, read, aggregate, "
+      "sort, delta, adapt, countries, extents, write, index or load (default "
+      "read)")
+  args = parser.parse_args()
+  if args.poiFile is None and args.delta is None and not args.render \
+      and args.serve is None:
+    parser.error("either a POI file, a --delta, --render or --serve is needed")
+  if args.index and not (args.in_memory or args.compact or args.incremental \
+      or args.delta or args.spill):
+    parser.error("--index needs --in-memory, --compact, --incremental or --spill")
+  if args.adaptive is not None and (args.incremental or args.delta \
+      or args.render or not (args.in_memory or args.compact or args.spill \
+      or args.serve is not None)):
+    parser.error("--adaptive needs --in-memory, --compact, --spill or --serve")
+  kb = KmlBuilder(args.poiFile, inMemory=args.in_memory,
+      bboxTableFile=args.bbox_table, outlines=args.outlines,
+      workers=args.workers, incremental=args.incremental, deltaFile=args.delta,
+      numPoiFiles=args.num_poi, kmzLevel=args.kmz,
+      coordinatesFile=args.coordinates, maxPlacemarks=args.max_placemarks,
+      compact=args.compact, spillDir=args.spill, indexHierarchy=args.index,
+      render=args.render, servePort=args.serve, serveCacheSize=args.serve_cache,
+      profileFile=args.profile, cprofileStage=args.cprofile_stage,
+      cprofileFile=args.cprofile, adaptivePoi=args.adaptive, tuneLods=args.lod,
+      mergePoi=args.merge_poi)
   sys.exit(kb.main())
 
@@ -0,0 +1,379 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import struct
+import sys
+import time
+import zipfile
+import zlib
+
+# The KML documents of the hierarchy are all built from the same handful of
+# fragments, so their templates are built once, here, rather than on every
+# call - most of all the style block which is the same for every document. A
+# document is then streamed, fragment by fragment, into a buffered file (or
+# any other file-like object) by a KmlWriter, rather than being concatenated
+# into one string first: that was quadratic in the number of inner geohashs,
+# which hurts in the densest cells.
+#
+# A document can also be written as a KMZ: a zip archive holding just the one
+# doc.kml, compressed as it is written.
+#
+# Usage: python kmlWriter.py [--cells 1000000] [--output DIR]
+#   benchmarks writing the KML of a synthetic hierarchy of that many cells
+
+BUFFER_SIZE = 1 << 16
+
+DOCUMENT_HEAD = """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+  %s
+  <Document> 
+    <name>%s</name>
+    """
+
+STYLES = """<Style id="g3">
+        <PolyStyle>
+          <color>281400FF</color>
+          <colorMode>normal</colorMode>
+          <fill>1</fill>
+        </PolyStyle>
+      </Style>
+      <Style id="g4">
+        <PolyStyle>
+          <color>2814B4FF</color>
+          <colorMode>normal</colorMode>
+          <fill>1</fill>
+        </PolyStyle>
+      </Style>
+      <Style id="g5">
+        <PolyStyle>
+          <color>1414F0FF</color>
+          <colorMode>normal</colorMode>
+          <fill>1</fill>
+        </PolyStyle>
+      </Style>
+    """
+
+# The finest geohashs STYLES has a style for: those of 6 digits and more, of
+# an adapted hierarchy, are drawn in the same style
+MAX_STYLE_LEVEL = 5
+
+DOCUMENT_TAIL = """
+  </Document>
+</kml>"""
+
+NETWORK_LINK_CONTROL = """  <NetworkLinkControl>
+     <!--<message>This is KML file %s</message>-->
+     <linkDescription><![CDATA[%s]]></linkDescription>
+    </NetworkLinkControl>"""
+# Note that the networkLinkControl could also have the following:
+# <linkName>New KML features</linkName>
+# <linkDescription><![CDATA[KML now has new features available!]]></linkDescription>
+# TODO: add the Camera element to this.
+
+COUNTRY_NETWORK_LINK_CONTROL = """  <NetworkLinkControl>
+     <!--<message>This is KML file %s</message>-->
+     <linkName>%s</linkName>
+     <linkDescription>%s</linkDescription>
+    </NetworkLinkControl>"""
+
+NETWORK_LINK = """
+  <NetworkLink>
+    <name>%s</name>
+    <Region>
+      <LatLonAltBox>
+        <north>%s</north>
+        <south>%s</south>
+        <east>%s</east>
+        <west>%s</west>
+      </LatLonAltBox>
+%s
+    </Region>
+    <Link>
+      <href>%s</href>
+      <viewRefreshMode>onRegion</viewRefreshMode>
+    </Link>
+   </NetworkLink>"""
+
+# The Lod of every NetworkLink, unless they are tuned (see lodTuning.py)
+DEFAULT_LOD = """      <Lod>
+        <minLodPixels>32</minLodPixels>
+        <maxLodPixels>768</maxLodPixels>
+      </Lod>"""
+
+FADING_LOD = """      <Lod>
+        <minLodPixels>%d</minLodPixels>
+        <maxLodPixels>%d</maxLodPixels>
+        <minFadeExtent>%d</minFadeExtent>
+        <maxFadeExtent>%d</maxFadeExtent>
+      </Lod>"""
+
+# The Region of a Placemark, which is only drawn while it is active
+PLACEMARK_REGION = """
+      <Region>
+        <LatLonAltBox>
+          <north>%s</north>
+          <south>%s</south>
+          <east>%s</east>
+          <west>%s</west>
+        </LatLonAltBox>
+%s
+      </Region>"""
+
+BOX_COORDINATES = "%s,%s %s,%s %s,%s %s,%s %s,%s"
+
+GEOHASH_COORDINATES = """%s,%s,%d
+            %s,%s,%d
+            %s,%s,%d
+            %s,%s,%d
+            %s,%s,%d"""
+
+COUNTRY_BORDER = """  <Placemark>
+      <name>%s outer bounding box</name>
+      <description>%s</description>
+      <styleUrl>#g0</styleUrl>
+        <LineString>
+          <extrude>0</extrude>
+          <tessellate>1</tessellate>
+          <coordinates>%s</coordinates>
+        </LineString>
+    </Placemark>"""
+
+COUNTRY_OUTLINE = """
+  <Placemark>
+      <name>%s outline</name>
+      <description>%s</description>
+      <styleUrl>#g0</styleUrl>
+      <MultiGeometry>
+%s
+      </MultiGeometry>
+    </Placemark>"""
+
+LINE_STRING = """        <LineString>
+          <extrude>0</extrude>
+          <tessellate>1</tessellate>
+          <coordinates>%s</coordinates>
+        </LineString>"""
+
+GEOHASH_BORDER = """  <Placemark>
+      <name>%s outer border</name>
+      <description>%s</description>
+      <styleUrl>#g%d</styleUrl>%s
+      <MultiGeometry>
+        <LineString>
+          <extrude>0</extrude>
+          <tessellate>1</tessellate>
+          <coordinates>%s</coordinates>
+        </LineString>
+        <Polygon>
+          <extrude>1</extrude>
+          <altitudeMode>relativeToGround</altitudeMode>
+          <outerBoundaryIs>
+            <LinearRing>
+              <coordinates>%s</coordinates>
+            </LinearRing>
+          </outerBoundaryIs>
+        </Polygon>
+      </MultiGeometry>
+    </Placemark>"""
+
+POI_PLACEMARK = """
+  <Placemark>
+      <name>%s</name>
+      <description>%s</description>
+      <Point>
+        <coordinates>%s,%s</coordinates>
+      </Point>
+    </Placemark>"""
+
+DENSE_PLACEMARK = """
+  <Placemark>
+      <name>%d POI</name>
+      <description>%s has %d POI, too many to show here: zoom in</description>
+      <Point>
+        <coordinates>%s,%s</coordinates>
+      </Point>
+    </Placemark>"""
+
+MERGED_PLACEMARK = """
+  <Placemark>
+      <name>%d POI</name>
+      <description>%d POI in %d small geohashs: zoom in</description>%s
+      <Point>
+        <coordinates>%s,%s</coordinates>
+      </Point>
+    </Placemark>"""
+
+
+class KmlWriter:
+  def __init__(self, f):
+    """ f is the file-like object the document is written to """
+    self.f = f
+    self.write = f.write
+
+  def begin(self, networkLinkControl, name):
+    self.write(DOCUMENT_HEAD % (networkLinkControl, name))
+    self.write(STYLES)
+
+  def networkLink(self, name, n, s, e, w, href, lod=DEFAULT_LOD):
+    self.write(NETWORK_LINK % (name, n, s, e, w, lod, href))
+
+  def end(self):
+    self.write(DOCUMENT_TAIL)
+
+  def close(self):
+    self.f.close()
+
+
+class KmzFile:
+  """ A file-like object that writes a KMZ: the data written to it is deflated
+    (at the given zlib level) as it comes and, on close, written out as the
+    doc.kml of a single-entry zip archive. The zipfile module of python 2.7
+    can't be told what level to compress at, hence the archive being written
+    here. """
+  ENTRY_NAME = "doc.kml"
+  # The entry is always dated 1980-01-01 00:00, so that the same document gives
+  # the same KMZ, byte for byte, whenever it is built.
+  DOS_DATE = (1 << 5) | 1
+  DOS_TIME = 0
+
+  def __init__(self, filename, level=6):
+    """ filename may also be a file-like object to write the KMZ to """
+    self.filename = filename
+    self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    self.chunks = []
+    self.crc = 0
+    self.size = 0
+
+  def write(self, data):
+    self.crc = zlib.crc32(data, self.crc)
+    self.size = self.size + len(data)
+    compressed = self.compressor.compress(data)
+    if compressed:
+      self.chunks.append(compressed)
+
+  def close(self):
+    self.chunks.append(self.compressor.flush())
+    compressed = "".join(self.chunks)
+    crc = self.crc & 0xffffffff
+    name = self.ENTRY_NAME
+    localHeader = struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader, \
+        20, 0, 0, zipfile.ZIP_DEFLATED, self.DOS_TIME, self.DOS_DATE, crc, \
+        len(compressed), self.size, len(name), 0)
+    centralDir = struct.pack(zipfile.structCentralDir, zipfile.stringCentralDir, \
+        20, 0, 20, 0, 0, zipfile.ZIP_DEFLATED, self.DOS_TIME, self.DOS_DATE, crc, \
+        len(compressed), self.size, len(name), 0, 0, 0, 0, 0644 << 16, 0)
+    centralDirOffset = len(localHeader) + len(name) + len(compressed)
+    endRecord = struct.pack(zipfile.structEndArchive, zipfile.stringEndArchive, \
+        0, 0, 1, 1, len(centralDir) + len(name), centralDirOffset, 0)
+    if hasattr(self.filename, "write"):
+      f = self.filename
+    else:
+      f = open(self.filename, "wb")
+    f.write(localHeader)
+    f.write(name)
+    f.write(compressed)
+    f.write(centralDir)
+    f.write(name)
+    f.write(endRecord)
+    f.close()
+
+
+def openKml(filename, kmzLevel=None):
+  """ opens a KmlWriter on the file (or file-like object), which is written as
+    a KMZ compressed at kmzLevel (0-9) when that is given """
+  if kmzLevel is None:
+    if hasattr(filename, "write"):
+      return KmlWriter(filename)
+    return KmlWriter(open(filename, "wb", BUFFER_SIZE))
+  return KmlWriter(KmzFile(filename, kmzLevel))
+
+
+class KmlBuffer:
+  """ A file-like object that keeps what's written to it, for the documents
+    that are served rather than saved """
+  def __init__(self):
+    self.chunks = []
+
+  def write(self, data):
+    self.chunks.append(data)
+
+  def close(self):
+    pass
+
+  def getvalue(self):
+    return "".join(self.chunks)
+
+
+class ByteCounter:
+  """ A file-like sink, for benchmarking the serialisation alone """
+  def __init__(self):
+    self.numBytes = 0
+
+  def write(self, data):
+    self.numBytes = self.numBytes + len(data)
+
+  def close(self):
+    pass
+
+
+def benchmark(numCells, output=None):
+  """ Writes a document per cell of a synthetic hierarchy of numCells cells,
+    breadth first: every cell has 32 children (as geohashs do) until there are
+    numCells of them. Each document has its border and a NetworkLink per
+    child. """
+  BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+  numBytes = 0
+  numDocuments = 0
+  numLinks = 0
+  numPlanned = 1
+  start = time.time()
+  parents = [""]
+  while parents:
+    children = []
+    for cell in parents:
+      message = "%s has 32 inner geohashs, 0 direct POI and 1024 descendent POI" % cell
+      if output is None:
+        sink = ByteCounter()
+        writer = KmlWriter(sink)
+      else:
+        dirname = os.path.join(output, *cell)
+        if not os.path.isdir(dirname):
+          os.makedirs(dirname)
+        writer = openKml(os.path.join(dirname, "index.kml"))
+      writer.begin(NETWORK_LINK_CONTROL % ("index.kml", message), cell)
+      coordinates = GEOHASH_COORDINATES % (1.40625, 45.0, 1024, -1.40625, 45.0, \
+          1024, -1.40625, 43.59375, 1024, 1.40625, 43.59375, 1024, 1.40625, 45.0, 1024)
+      writer.write(GEOHASH_BORDER % (cell, message, \
+          min(len(cell), MAX_STYLE_LEVEL), "", coordinates, coordinates))
+      for c in BASE32:
+        if numPlanned >= numCells:
+          break
+        writer.networkLink(cell + c, 45.0, 43.59375, 1.40625, -1.40625, \
+            "./%s/index.kml" % c)
+        children.append(cell + c)
+        numPlanned = numPlanned + 1
+        numLinks = numLinks + 1
+      writer.end()
+      writer.close()
+      if output is None:
+        numBytes = numBytes + sink.numBytes
+      else:
+        numBytes = numBytes + os.path.getsize(os.path.join(dirname, "index.kml"))
+      numDocuments = numDocuments + 1
+    parents = children
+  elapsed = time.time() - start
+  print "%d documents, %d NetworkLinks, %dMB in %.2fs: %.1fMB/s, %d documents/s" % \
+      (numDocuments, numLinks, numBytes >> 20, elapsed, \
+      numBytes / elapsed / (1 << 20), numDocuments / elapsed)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description="Benchmarks the KML serialisation over a synthetic hierarchy")
+  parser.add_argument("--cells", type=int, default=1000000)
+  parser.add_argument("--output", metavar="DIR",
+      help="write the documents under DIR rather than just counting bytes")
+  args = parser.parse_args()
+  benchmark(args.cells, args.output)
+  sys.exit(0)
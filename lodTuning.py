@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import math
+
+import kmlWriter
+
+# The Lods of the regions of the hierarchy, tuned to the geohashs' sizes and to
+# the density of their POI rather than the same 32/768 pixels everywhere - with
+# which a zoomed out client fetches the document of every cell that's a mere
+# 32 pixels across, and unloads a cell (and everything below it) once it's more
+# than 768 pixels across.
+#  - A NetworkLink's document is fetched once its cell is big enough on screen
+#    to be worth the fetch - MIN_LOD_PIXELS across - with room on top of that
+#    for what it draws - its inner geohashs' borders, or its Placemarks - to be
+#    about FEATURE_SPACING pixels apart: the more POI, the closer in, however
+#    few there are. A cell that's several digits below the document linking to
+#    it (the end of a collapsed chain of an adapted hierarchy) is that much
+#    smaller, and its floor is that much lower - else it would only be fetched
+#    once the document's own cell was far bigger than the screen. It is never
+#    unloaded on the way in (maxLodPixels -1), so that what is below it stays,
+#    and it fades in.
+#  - The border of a geohash that has inner geohashs fades out once they are
+#    all being drawn in its place: once the last of their links is fetched -
+#    the largest of their minLodPixels, times the ratio of the sizes of the
+#    geohash and of that inner geohash.
+#  - Optionally, the small inner geohashs of a cell - of no more than mergePoi
+#    POI - are drawn as one Placemark of all of their POI until the client is
+#    close enough in for them to be worth fetching one by one.
+
+# The sizes, in pixels, within which a NetworkLink's document is fetched
+MIN_LOD_PIXELS = 128
+MAX_LOD_PIXELS = 1024
+# The distance, in pixels, that the features of a document should be apart
+FEATURE_SPACING = 16
+# The most inner geohashs a cell can have
+MAX_INNER = 32
+# The small inner geohashs are fetched only once they are this much bigger
+MERGED_LOD_FACTOR = 4
+
+def sizeRatio(depth):
+  """ the ratio of the sizes (the square roots of the areas) of a geohash and
+    of those depth digits longer - each digit is a 32nd of the area """
+  return math.sqrt(32 ** depth)
+
+def lod(minLodPixels, maxLodPixels, minFadeExtent=0, maxFadeExtent=0):
+  return kmlWriter.FADING_LOD % (minLodPixels, maxLodPixels, minFadeExtent, \
+      maxFadeExtent)
+
+
+class LodTuning:
+  def __init__(self, maxPlacemarks=0, mergePoi=None):
+    """ maxPlacemarks is the most Placemarks that a document draws, 0 when the
+      POI are not drawn at all """
+    self.maxFeatures = max(MAX_INNER, maxPlacemarks)
+    self.mergePoi = mergePoi
+
+  def minLodPixels(self, numPoi, depth=1):
+    """ the size at which the document of a cell of numPoi POI, depth digits
+      below the document linking to it, is fetched """
+    features = min(numPoi, self.maxFeatures)
+    floor = MIN_LOD_PIXELS / sizeRatio(depth - 1)
+    # The area of the floor, and as much again for each feature
+    minLodPixels = math.sqrt(floor ** 2 + features * FEATURE_SPACING ** 2)
+    return int(round(min(MAX_LOD_PIXELS, max(FEATURE_SPACING, minLodPixels))))
+
+  def linkPixels(self, numPoi, depth=1, merged=False):
+    """ the minLodPixels of the NetworkLink to a cell of numPoi POI, depth
+      digits below the document - merged into one Placemark with its small
+      siblings or not """
+    minLodPixels = self.minLodPixels(numPoi, depth)
+    if merged:
+      minLodPixels = minLodPixels * MERGED_LOD_FACTOR
+    return minLodPixels
+
+  def linkLod(self, minLodPixels):
+    """ the Lod of a NetworkLink that's fetched at minLodPixels """
+    return lod(minLodPixels, -1, minLodPixels / 2)
+
+  def borderRegion(self, geohash, bbox, linkPixels):
+    """ the Region of the border of a geohash, of the given bbox, whose inner
+      geohashs' NetworkLinks are fetched at linkPixels - a dict of their
+      minLodPixels by inner geohash """
+    if not linkPixels:
+      return ""
+    maxLodPixels = int(round(max(minLodPixels * \
+        sizeRatio(len(innerGeohash) - len(geohash)) \
+        for (innerGeohash, minLodPixels) in linkPixels.iteritems())))
+    return kmlWriter.PLACEMARK_REGION % (bbox['n'], bbox['s'], bbox['e'], \
+        bbox['w'], lod(0, maxLodPixels, 0, maxLodPixels / 4))
+
+  def merged(self, innerGeohashs):
+    """ returns the names of those of the inner geohashs that are drawn as one
+      Placemark - none, unless at least two are small enough """
+    if self.mergePoi is None:
+      return set()
+    small = set(innerGeohash["name"] for innerGeohash in innerGeohashs \
+        if innerGeohash["numPoi"] <= self.mergePoi)
+    if len(small) < 2:
+      return set()
+    return small
+
+  def mergedPlacemark(self, innerGeohashs, bboxes, linkPixels):
+    """ the Placemark of the merged inner geohashs, whose bboxes and the
+      minLodPixels of whose links (by inner geohash) are given: at the middle
+      of their POI, and drawn until they are fetched """
+    numPoi = sum(innerGeohash["numPoi"] for innerGeohash in innerGeohashs)
+    (lat, lng) = (0.0, 0.0)
+    for (innerGeohash, bbox) in zip(innerGeohashs, bboxes):
+      weight = float(innerGeohash["numPoi"]) / max(numPoi, 1)
+      lat = lat + weight * (bbox['n'] + bbox['s']) / 2
+      lng = lng + weight * (bbox['e'] + bbox['w']) / 2
+    n = max(bbox['n'] for bbox in bboxes)
+    s = min(bbox['s'] for bbox in bboxes)
+    e = max(bbox['e'] for bbox in bboxes)
+    w = min(bbox['w'] for bbox in bboxes)
+    # The merged geohashs are fetched once they are this size, which is when
+    # the box of them all is (about) maxLodPixels
+    minLodPixels = min(linkPixels[innerGeohash["name"]] \
+        for innerGeohash in innerGeohashs)
+    cellArea = sum((bbox['n'] - bbox['s']) * (bbox['e'] - bbox['w']) \
+        for bbox in bboxes) / len(bboxes)
+    maxLodPixels = int(round(minLodPixels * math.sqrt((n - s) * (e - w) / cellArea)))
+    region = kmlWriter.PLACEMARK_REGION % (n, s, e, w, \
+        lod(0, maxLodPixels, 0, maxLodPixels / 4))
+    return kmlWriter.MERGED_PLACEMARK % (numPoi, numPoi, len(innerGeohashs), \
+        region, lng, lat)
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import os
+import struct
+
+# The manifest of a build records, for every cell of the hierarchy (the root,
+# the countries and their 3, 4 & 5-digit geohashs), the number of POI in it and
+# a hash of the set of those POI. The hash of a set is the XOR of the hashes of
+# its ppids, so it does not depend on the order they were read in, and as a
+# cell's hash covers all of its descendents any change in a cell changes the
+# hash of all of its ancestors too - exactly the cells whose KML needs to be
+# rewritten.
+#
+# The ppids of the leaves are kept as well, so that a delta of adds & removes
+# can be applied to the previous build without the previous POI file. The
+# manifest is a gzip'ed text file with one cell per line:
+#   {country:3}{geohash:0-5}\t{numPoi}\t{hash:hex}[\t{ppid},{ppid},...]
+# after a first line of the rendering options the KML was written with:
+#   #options\t{name}={value}\t{name}={value}...
+# The KML of the unchanged cells can only be kept when they are the same.
+
+def ppidHash(ppid):
+  return struct.unpack("<Q", hashlib.md5(ppid).digest()[:8])[0]
+
+def cellHashes(trie):
+  """ returns a dict of cell -> (numPoi, hash) for every node of the trie """
+  hashes = dict()
+  for path, node in trie.walk():
+    h = 0
+    for ppid in node.ppids:
+      h = h ^ ppidHash(ppid)
+    for key in node.children:
+      h = h ^ hashes["".join(path + (key,))][1]
+    hashes["".join(path)] = (node.numPoi, h)
+  return hashes
+
+def load(filename, trie=None):
+  """ Returns the dict of cell -> (numPoi, hash) of the manifest, empty when
+    there is none yet, and the dict of the rendering options it was written
+    with (as strings), None when there is none. When a trie is given the
+    ppids are added to it. """
+  hashes = dict()
+  options = None
+  if not os.path.exists(filename):
+    return hashes, options
+  f = gzip.open(filename, "rb")
+  try:
+    for line in f:
+      fields = line.rstrip("\n").split("\t")
+      if fields[0] == "#options":
+        options = dict(field.split("=", 1) for field in fields[1:])
+        continue
+      hashes[fields[0]] = (int(fields[1]), int(fields[2], 16))
+      if trie is not None and len(fields) > 3:
+        for ppid in fields[3].split(","):
+          trie.add(ppid)
+  finally:
+    f.close()
+  return hashes, options
+
+def save(filename, trie, hashes, options):
+  """ options is the dict of the rendering options, as strings """
+  # Written alongside and then renamed, so that an interrupted run can't leave
+  # a manifest that doesn't match the KML.
+  f = gzip.open("%s.tmp" % filename, "wb")
+  try:
+    f.write("\t".join(["#options"] + ["%s=%s" % (name, options[name]) \
+        for name in sorted(options)]))
+    f.write("\n")
+    for path, node in trie.walk():
+      cell = "".join(path)
+      (numPoi, h) = hashes[cell]
+      line = "%s\t%d\t%016x" % (cell, numPoi, h)
+      if node.ppids:
+        line = "%s\t%s" % (line, ",".join(node.ppids))
+      f.write(line)
+      f.write("\n")
+  finally:
+    f.close()
+  os.rename("%s.tmp" % filename, filename)
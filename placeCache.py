@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import sqlite3
+import threading
+import time
+
+# A persistent cache of the places API's answers, so that the names and
+# coordinates of places - which rarely change - are not fetched again on every
+# run. It's an SQLite file keyed by ppid holding just what is used of each
+# place: its name and coordinates, or nothing when the API had no such place
+# (which is worth remembering too). Entries older than the TTL are fetched
+# again; when there are more than maxEntries, the least recently used go.
+
+class PlaceCache:
+  # Commit after this many puts, rather than after every one
+  COMMIT_EVERY = 100
+
+  def __init__(self, filename, ttl=30 * 24 * 3600, maxEntries=1000000):
+    self.ttl = ttl
+    self.maxEntries = maxEntries
+    self.hits = 0
+    self.misses = 0
+    self.evicted = 0
+    self.uncommitted = 0
+    # The fetching threads all share the one connection, one at a time
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    self.db.execute("""CREATE TABLE IF NOT EXISTS places (
+        ppid TEXT PRIMARY KEY,
+        fetched REAL NOT NULL,
+        accessed REAL NOT NULL,
+        name TEXT,
+        lat REAL,
+        lng REAL)""")
+    self.db.execute("CREATE INDEX IF NOT EXISTS placesAccessed ON places (accessed)")
+    self.size = self.db.execute("SELECT COUNT(*) FROM places").fetchone()[0]
+
+  def get(self, ppid, stale=False):
+    """ Returns the (name, lat, lng) of the ppid - all None when there is no such
+      place - or None when it's not cached (or has expired, unless stale ones
+      will do). """
+    now = time.time()
+    with self.lock:
+      row = self.db.execute("SELECT fetched, name, lat, lng FROM places " \
+          "WHERE ppid = ?", (ppid,)).fetchone()
+      if row is None or (not stale and row[0] < now - self.ttl):
+        self.misses = self.misses + 1
+        return None
+      self.hits = self.hits + 1
+      self.db.execute("UPDATE places SET accessed = ? WHERE ppid = ?", (now, ppid))
+      return row[1:]
+
+  def put(self, ppid, name, lat, lng):
+    now = time.time()
+    with self.lock:
+      self.db.execute("INSERT OR REPLACE INTO places " \
+          "(ppid, fetched, accessed, name, lat, lng) VALUES (?, ?, ?, ?, ?, ?)", \
+          (ppid, now, now, name, lat, lng))
+      self.size = self.size + 1
+      self.uncommitted = self.uncommitted + 1
+      if self.uncommitted >= self.COMMIT_EVERY:
+        self.evict()
+        self.db.commit()
+        self.uncommitted = 0
+
+  def evict(self):
+    """ drops the least recently used entries beyond maxEntries """
+    # self.size over-counts replaced entries, so only count when it matters
+    if self.size <= self.maxEntries:
+      return
+    self.size = self.db.execute("SELECT COUNT(*) FROM places").fetchone()[0]
+    excess = self.size - self.maxEntries
+    if excess > 0:
+      self.db.execute("DELETE FROM places WHERE ppid IN (SELECT ppid FROM places " \
+          "ORDER BY accessed LIMIT ?)", (excess,))
+      self.evicted = self.evicted + excess
+      self.size = self.maxEntries
+
+  def close(self):
+    with self.lock:
+      self.evict()
+      self.db.commit()
+      self.db.close()
+
+  def stats(self):
+    return "cache: %d hits, %d misses, %d evicted, %d entries" % \
+        (self.hits, self.misses, self.evicted, self.size)
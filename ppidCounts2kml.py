@@ -1,54 +1,232 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import geohash
+import argparse
+import collections
+import itertools
 import sys
 import json
+import math
+import threading
+import time
 import requests
+from xml.sax.saxutils import escape
+from multiprocessing.pool import ThreadPool
+
+from geohashTable import BASE32, decode
+from inputStream import InputStream
+from placeCache import PlaceCache
+
+class RateLimiter:
+  """ Spaces calls to wait() - from any number of threads - out so that there
+    are no more than rate of them a second. A rate of None is no limit. """
+  def __init__(self, rate=None):
+    self.interval = 0
+    if rate:
+      self.interval = 1.0 / rate
+    self.lock = threading.Lock()
+    self.next = 0
+
+  def wait(self):
+    if not self.interval:
+      return
+    with self.lock:
+      now = time.time()
+      at = max(now, self.next)
+      self.next = at + self.interval
+    if at > now:
+      time.sleep(at - now)
+
 
 class PpidCounts2KML:
   URL = "http://api.places.maps.ovi.com/rest/v1/places/%s"
   PROXY = {"http" :  "http://nokes.nokia.com:8080"}
   TIMEOUT = 1.1
+  # The first retry is after BACKOFF seconds, and each after that waits twice
+  # as long as the one before.
+  BACKOFF = 0.5
 
-  def __init__(self, filename):
-    self.csvs = open(filename,"r").readlines()
+  # The heatmap rolls the view counts up to each of these geohash lengths
+  HEATMAP_LEVELS = (3, 4, 5)
+  # and colours its cells, from green to red, in this many steps
+  HEATMAP_COLOURS = 10
+
+  def __init__(self, filename, concurrency=8, rate=None, retries=2, url=URL,
+      proxies=PROXY, cache=None, offline=False, limit=None):
+    # The CSV is streamed (it may be gzip'ed, bzip2'ed or "-" for stdin) rather
+    # than read into memory.
+    self.csvs = InputStream(filename)
     self.geohashCount = {}
+    self.geohashCountLock = threading.Lock()
+    self.concurrency = concurrency
+    self.retries = retries
+    self.url = url
+    self.proxies = proxies
+    self.rateLimiter = RateLimiter(rate)
+    # With a PlaceCache, places are only fetched when they're not in it - and
+    # offline, never.
+    self.cache = cache
+    self.offline = offline
+    self.limit = limit
+    # One session for all of the requests, so that connections are kept alive
+    # and reused, with a connection in its pool for each of the threads.
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, \
+        pool_maxsize=concurrency)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
 
   def run(self):
-    #print self.csvs
-    #print geohash.decode("u27")
-    #print geohash.bbox("u27")
+    """ A pipeline: the CSV is read, its places fetched (or looked up) and
+      their Placemarks printed as they come - in the CSV's order - so that
+      memory doesn't grow with the size of the CSV. """
+    csvs = self.csvs
+    if self.limit is not None:
+      csvs = itertools.islice(csvs, self.limit)
+    self.dumpHeader()
+    i = 0
+    for place in self.fetchPlaces(csvs):
+      i = i + 1
+      self.dumpPlace(place)
+      if i % 100 == 0:
+        sys.stdout.flush()
+        sys.stderr.write("%d places (%s)\n" % (i, self.csvs.progress()))
+    self.dumpFooter()
+    if self.cache is not None:
+      self.cache.close()
+      sys.stderr.write("%s\n" % self.cache.stats())
+
+  def runHeatmap(self, heightMultiplier=1.0):
+    """ Prints a heatmap of the view counts - no places are fetched, only the
+      CSV is read - as a Folder per geohash length of extruded cells, each as
+      high as its views (times heightMultiplier) and coloured by where its
+      views fall between the fewest and most of its level. """
+    csvs = self.csvs
+    if self.limit is not None:
+      csvs = itertools.islice(csvs, self.limit)
+    # Just the 5-digit counts are kept while reading, as there are far fewer of
+    # them than rows: the shorter geohashs are summed from those afterwards.
+    geohashCount = self.geohashCount
     i = 0
-    for csv in self.csvs:
+    skipped = 0
+    for csv in csvs:
       i = i + 1
-      place = self.processPlace(csv, i)
-      self.csvs[i - 1] = place
-      if i == 1001:
-        self.csvs = self.csvs[:i]
-        break
-    self.dump()
+      try:
+        (ppid, count) = csv.split(",")
+        count = long(count)
+      except ValueError:
+        # Not a {ppid},{view count} line (a header, perhaps)
+        continue
+      gh = ppid[3:8]
+      # Only geohash digits are left once those are deleted: anything else
+      # would only fail to decode once the KML is half printed
+      if len(gh) < self.HEATMAP_LEVELS[0] or gh.translate(None, BASE32):
+        skipped = skipped + 1
+        continue
+      geohashCount[gh] = geohashCount.get(gh, 0) + count
+      if i % 1000000 == 0:
+        sys.stderr.write("%d rows (%s)\n" % (i, self.csvs.progress()))
+    if skipped:
+      sys.stderr.write("Skipped %d rows without a geohash of at least %d " \
+          "digits\n" % (skipped, self.HEATMAP_LEVELS[0]))
+    self.dumpHeatmapHeader()
+    for length in self.HEATMAP_LEVELS:
+      counts = dict()
+      for (gh, count) in geohashCount.iteritems():
+        if len(gh) < length:
+          continue
+        key = gh[:length]
+        counts[key] = counts.get(key, 0) + count
+      self.dumpHeatmapLevel(length, counts, heightMultiplier)
+    self.dumpFooter()
+
+  def fetchPlaces(self, csvs):
+    """ Yields the place of each of the csvs, in their order, while fetching up
+      to concurrency of them at a time. No more than a few times concurrency
+      are ever waiting to be yielded, however many csvs there are. """
+    pool = ThreadPool(self.concurrency)
+    pending = collections.deque()
+    try:
+      index = 0
+      for csv in csvs:
+        index = index + 1
+        pending.append(pool.apply_async(self.processPlace, (csv, index)))
+        if len(pending) >= 4 * self.concurrency:
+          yield pending.popleft().get()
+      while pending:
+        yield pending.popleft().get()
+    finally:
+      pool.terminate()
+
+  def fetch(self, url):
+    """ GETs the url, retrying timeouts, failed connections and the server
+      being overloaded (a 5xx or 429) - with an exponential backoff - up to
+      retries times. Returns None on failure. """
+    backoff = self.BACKOFF
+    for attempt in range(self.retries + 1):
+      self.rateLimiter.wait()
+      try:
+        resp = self.session.get(url=url, proxies=self.proxies, timeout=self.TIMEOUT)
+        if resp.status_code < 500 and resp.status_code != 429:
+          return resp
+      except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+        # Timeouts are the most likely problem here, and are worth retrying
+        pass
+      except requests.exceptions.RequestException:
+        return None
+      if attempt < self.retries:
+        time.sleep(backoff)
+        backoff = 2 * backoff
+    return None
+
+  def lookupPlace(self, ppid):
+    """ Returns the (name, lat, lng) of the ppid - from the cache when it's
+      there - all None when the API has no such place, or None when that's not
+      known (as the request failed, or it's not cached and we're offline). """
+    if self.cache is not None:
+      place = self.cache.get(ppid, stale=self.offline)
+      if place is not None or self.offline:
+        return place
+    resp = self.fetch(self.url % ppid)
+    if resp is None:
+      # for this we can skip
+      return None
+    # Only a 404 says there's no such place: any other error is not cached,
+    # so that the place is asked for again next time
+    if resp.status_code == 404:
+      data = dict()
+    elif resp.status_code != 200:
+      return None
+    else:
+      try:
+        data = json.loads(resp.content)
+      except ValueError:
+        return None
+    # The JSON has a root node called "place" in which everything is found
+    if "place" not in data:
+      # When the response does not contain a "place" object, there is little
+      # we can do - other than remember that
+      place = (None, None, None)
+    else:
+      data = data["place"]
+      place = (data["names"]["defaultName"]["name"],
+               data["location"]["geoCoordinates"]["latitude"],
+               data["location"]["geoCoordinates"]["longitude"])
+    if self.cache is not None:
+      self.cache.put(ppid, *place)
+    return place
 
   def processPlace(self, csv, index):
     (ppid, count) = csv.split(",")
     count = long(count)
     gh = ppid[3:8]
     self.updateGeohashCount(gh, count)
-    url = self.URL % ppid
-    try:
-      resp = requests.get(url=url, proxies=self.PROXY, timeout=self.TIMEOUT)
-    except requests.exceptions.RequestException:
-      # Timeouts are the most likely problem here, but for this we can skip
+    place = self.lookupPlace(ppid)
+    if place is None:
       return None
-    data = json.loads(resp.content)
-    # The JSON has a root node called "place" in which everything is found
-    if "place" not in data:
-      # When the response does not contain a "place" object, there is little
-      # we can do
+    (name, lat, lng) = place
+    if name is None:
       return None
-    data = data["place"]
-    name = data["names"]["defaultName"]["name"]
-    lat = data["location"]["geoCoordinates"]["latitude"]
-    lng = data["location"]["geoCoordinates"]["longitude"]
     return { "ppid": ppid,
              "name": "#%d (%d views): %s" % (index, count, name.replace("&", "&amp;")), 
              "count": count, 
@@ -57,13 +235,15 @@ class PpidCounts2KML:
              "geohash":gh }
     
   def updateGeohashCount(self, gh, count):
-    if gh in self.geohashCount:
-      self.geohashCount[gh] = self.geohashCount[gh] + count
-    else:
-      self.geohashCount[gh] = count
+    # Called from all of the fetching threads
+    with self.geohashCountLock:
+      if gh in self.geohashCount:
+        self.geohashCount[gh] = self.geohashCount[gh] + count
+      else:
+        self.geohashCount[gh] = count
 
 
-  def dump(self):
+  def dumpHeader(self):
     print """<?xml version="1.0" encoding="UTF-8"?>
 <kml xmlns="http://earth.google.com/kml/2.1">
   <Document 
@@ -77,8 +257,69 @@ class PpidCounts2KML:
         <fill>1</fill>
       </PolyStyle>
     </Style>"""
-    for place in self.csvs:
-      self.dumpPlace(place)
+
+  def dumpHeatmapHeader(self):
+    styles = []
+    for step in range(self.HEATMAP_COLOURS):
+      red = 255 * step / (self.HEATMAP_COLOURS - 1)
+      styles.append("""    <Style id="heat%d">
+      <LineStyle>
+        <width>0</width>
+      </LineStyle>
+      <PolyStyle>
+        <color>b000%02x%02x</color><!-- aabbggrr -->
+      </PolyStyle>
+    </Style>""" % (step, 255 - red, red))
+    print """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+  <Document>
+    <name>%s</name>
+%s""" % (escape(self.csvs.filename), "\n".join(styles))
+
+  def dumpHeatmapLevel(self, length, counts, heightMultiplier):
+    """ prints a Folder of the cells of a level - only the 3-digit level is
+      visible to start with, as the others hide it - coloured by the log of
+      their counts as the counts of the busiest cells dwarf the rest """
+    if not counts:
+      return
+    low = math.log(min(counts.itervalues()) + 1)
+    high = math.log(max(counts.itervalues()) + 1)
+    scale = 0
+    if high > low:
+      scale = (self.HEATMAP_COLOURS - 1) / (high - low)
+    visibility = int(length == self.HEATMAP_LEVELS[0])
+    print """    <Folder>
+      <name>%d-digit geohashs</name>
+      <visibility>%d</visibility>""" % (length, visibility)
+    geohashs = sorted(counts)
+    # All of the level's cells are decoded in one go
+    (south, west, north, east) = decode(geohashs)
+    for (gh, s, w, n, e) in itertools.izip(geohashs, south.tolist(), \
+        west.tolist(), north.tolist(), east.tolist()):
+      count = counts[gh]
+      step = int(round((math.log(count + 1) - low) * scale))
+      height = heightMultiplier * count
+      corners = []
+      for (lng, lat) in ((e, n), (w, n), (w, s), (e, s), (e, n)):
+        corners.append("%s,%s,%s" % (lng, lat, height))
+      print """      <Placemark>
+        <name>%s</name>
+        <description>%d views</description>
+        <visibility>%d</visibility>
+        <styleUrl>#heat%d</styleUrl>
+        <Polygon>
+          <extrude>1</extrude>
+          <altitudeMode>relativeToGround</altitudeMode>
+          <outerBoundaryIs>
+            <LinearRing>
+              <coordinates>%s</coordinates>
+            </LinearRing>
+          </outerBoundaryIs>
+        </Polygon>
+      </Placemark>""" % (gh, count, visibility, step, " ".join(corners))
+    print "    </Folder>"
+
+  def dumpFooter(self):
     print """  </Document>
 </kml>"""
     
@@ -103,8 +344,51 @@ class PpidCounts2KML:
     print placemark.encode("utf-8")
 
 def main(argv):
-  x = PpidCounts2KML(argv[0])
-  x.run()
+  parser = argparse.ArgumentParser(
+      description="Prints KML of the places of a CSV of {ppid},{view count}")
+  parser.add_argument("filename")
+  parser.add_argument("--concurrency", type=int, default=8, metavar="N",
+      help="fetch up to N places at a time")
+  parser.add_argument("--rate", type=float, metavar="N",
+      help="make no more than N requests a second")
+  parser.add_argument("--retries", type=int, default=2, metavar="N",
+      help="retry a timed out request up to N times")
+  parser.add_argument("--url", default=PpidCounts2KML.URL,
+      help="the places API, with a %%s for the ppid")
+  parser.add_argument("--proxy", default=PpidCounts2KML.PROXY["http"],
+      help="the HTTP proxy to use, empty for none")
+  parser.add_argument("--cache", metavar="FILE",
+      help="cache the places in the SQLite FILE, and only fetch those not in it")
+  parser.add_argument("--cache-ttl", type=float, default=30, metavar="DAYS",
+      help="fetch cached places again after DAYS")
+  parser.add_argument("--cache-size", type=int, default=1000000, metavar="N",
+      help="keep no more than the N most recently used places in the cache")
+  parser.add_argument("--offline", action="store_true",
+      help="only use the places in the cache, however old")
+  parser.add_argument("--limit", type=int, metavar="N",
+      help="only the first N places of the CSV")
+  parser.add_argument("--heatmap", action="store_true",
+      help="print a heatmap of the views of each 3, 4 and 5-digit geohash " \
+      "instead, from the CSV alone (no places are fetched)")
+  parser.add_argument("--height-multiplier", type=float, default=1.0, metavar="M",
+      help="the heatmap's cells are M metres high per view")
+  args = parser.parse_args(argv)
+  if args.offline and args.cache is None:
+    parser.error("--offline needs a --cache")
+  cache = None
+  if args.cache is not None:
+    cache = PlaceCache(args.cache, ttl=args.cache_ttl * 24 * 3600,
+        maxEntries=args.cache_size)
+  proxies = dict()
+  if args.proxy:
+    proxies["http"] = args.proxy
+  x = PpidCounts2KML(args.filename, concurrency=args.concurrency, rate=args.rate,
+      retries=args.retries, url=args.url, proxies=proxies, cache=cache,
+      offline=args.offline, limit=args.limit)
+  if args.heatmap:
+    x.runHeatmap(args.height_multiplier)
+  else:
+    x.run()
 
 if __name__ == "__main__":
   main(sys.argv[1:])
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import numpy
+
+from geohashTable import BASE32, DECODE_ARRAY
+
+# A compact representation of ppids for ingest. A ppid such as
+#   724ezjmd-e400738407474eb9b82e1e16ecb8efbc
+# is a 3-digit country code, a 5-digit geohash and a 128-bit UUID, which as a
+# python string (in a list) costs well over a hundred bytes. Packed, it's a
+# 24-byte record: the country code and the geohash's base32 value in one 64-bit
+# "cell" key, and the UUID as two 64-bit halves. The cell keys sort in the same
+# order as the {cc}{gh} strings do (the BASE32 digits are in ASCII order), so
+# once the records are sorted by cell, all of the ppids of a cell are adjacent
+# and grouping them is one linear scan.
+#
+# Only ppids of exactly that form - a numeric country code, a 5-digit geohash
+# and 32 lower-case hex digits - can be packed; the rest are counted and left
+# out.
+
+PPID_LENGTH = 41
+
+RECORD = numpy.dtype([("cell", "<u8"), ("uuidHi", "<u8"), ("uuidLo", "<u8")])
+
+HEX = "0123456789abcdef"
+# HEX as an array indexed by character code, -1 for those not in it
+HEX_ARRAY = numpy.empty(256, dtype=numpy.int64)
+HEX_ARRAY.fill(-1)
+for (i, c) in enumerate(HEX):
+  HEX_ARRAY[ord(c)] = i
+
+def pack(lines):
+  """ Packs the ppids of the lines (which may still end with a newline) into an
+    array of RECORDs, returning it and the number of lines that couldn't be """
+  ppids = numpy.array([line.rstrip("\n") for line in lines], dtype=numpy.string_)
+  if len(ppids) == 0 or ppids.dtype.itemsize < PPID_LENGTH:
+    return numpy.empty(0, dtype=RECORD), len(ppids)
+  valid = numpy.char.str_len(ppids) == PPID_LENGTH
+  chars = ppids.astype("S%d" % PPID_LENGTH).view(numpy.uint8) \
+      .reshape(len(ppids), PPID_LENGTH).astype(numpy.int64)
+  valid &= chars[:, 8] == ord("-")
+  countryCode = chars[:, 0:3] - ord("0")
+  valid &= ((countryCode >= 0) & (countryCode <= 9)).all(axis=1)
+  geohash = DECODE_ARRAY[chars[:, 3:8]]
+  valid &= (geohash >= 0).all(axis=1)
+  uuid = HEX_ARRAY[chars[:, 9:PPID_LENGTH]]
+  valid &= (uuid >= 0).all(axis=1)
+
+  countryCode = countryCode[valid]
+  geohash = geohash[valid]
+  uuid = uuid[valid].astype(numpy.uint64)
+  records = numpy.empty(len(countryCode), dtype=RECORD)
+  cell = 100 * countryCode[:, 0] + 10 * countryCode[:, 1] + countryCode[:, 2]
+  for column in range(5):
+    cell = (cell << 5) | geohash[:, column]
+  records["cell"] = cell
+  hi = numpy.zeros(len(uuid), dtype=numpy.uint64)
+  lo = numpy.zeros(len(uuid), dtype=numpy.uint64)
+  for column in range(16):
+    hi = (hi << numpy.uint64(4)) | uuid[:, column]
+    lo = (lo << numpy.uint64(4)) | uuid[:, 16 + column]
+  records["uuidHi"] = hi
+  records["uuidLo"] = lo
+  return records, len(ppids) - len(records)
+
+def cellChars(cells, chars):
+  """ writes the {cc:3}{gh:5} characters of the cell keys into the first 8
+    columns of the uint8 array chars """
+  cell = cells.astype(numpy.int64)
+  base32 = numpy.frombuffer(BASE32, dtype=numpy.uint8)
+  for column in range(4, -1, -1):
+    chars[:, 3 + column] = base32[cell & 31]
+    cell = cell >> 5
+  for column in range(2, -1, -1):
+    chars[:, column] = ord("0") + cell % 10
+    cell = cell // 10
+
+def cellNames(cells):
+  """ returns the list of the {cc:3}{gh:5} strings of an array of cell keys """
+  chars = numpy.empty((len(cells), 8), dtype=numpy.uint8)
+  cellChars(cells, chars)
+  return chars.view("S8").ravel().tolist()
+
+def toPpids(records):
+  """ returns the list of ppid strings of an array of RECORDs - or the ppids
+    themselves, when they are not records """
+  if not isinstance(records, numpy.ndarray):
+    return records
+  chars = numpy.empty((len(records), PPID_LENGTH), dtype=numpy.uint8)
+  cellChars(records["cell"], chars)
+  chars[:, 8] = ord("-")
+  hexDigits = numpy.frombuffer(HEX, dtype=numpy.uint8)
+  for (field, start) in (("uuidHi", 9), ("uuidLo", 25)):
+    half = records[field]
+    for column in range(15, -1, -1):
+      chars[:, start + column] = hexDigits[(half & numpy.uint64(15)).astype(numpy.int64)]
+      half = half >> numpy.uint64(4)
+  return chars.view("S%d" % PPID_LENGTH).ravel().tolist()
+
+
+class PpidRecords:
+  """ Collects chunks of packed ppids and, once they are all in, sorts them by
+    cell - stably, so that each cell's ppids stay in the order they were
+    added. """
+  def __init__(self):
+    self.chunks = []
+    self.records = numpy.empty(0, dtype=RECORD)
+    self.rejected = 0
+
+  def add(self, lines):
+    (records, rejected) = pack(lines)
+    self.chunks.append(records)
+    self.rejected = self.rejected + rejected
+    return len(records)
+
+  def sort(self):
+    records = numpy.concatenate([self.records] + self.chunks)
+    self.chunks = []
+    order = numpy.argsort(records["cell"], kind="mergesort")
+    self.records = records[order]
+
+  def __len__(self):
+    return len(self.records) + sum(len(chunk) for chunk in self.chunks)
+
+  def cells(self):
+    """ yields the ({cc:3}{gh:5} cell, records) of every cell, in order - the
+      records being a slice (not a copy) of the sorted records """
+    cells = self.records["cell"]
+    if len(cells) == 0:
+      return
+    starts = numpy.concatenate(([0], numpy.flatnonzero(cells[1:] != cells[:-1]) + 1))
+    names = cellNames(cells[starts])
+    starts = starts.tolist() + [len(cells)]
+    records = self.records
+    for i in xrange(len(names)):
+      yield names[i], records[starts[i]:starts[i + 1]]
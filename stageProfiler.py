@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import json
+import resource
+import sys
+import time
+
+# Where a build's time (and memory) goes. A build is a sequence of stages -
+# reading the POI, computing the country extents, writing the KML, ... - and
+# for each of them the profiler records its wall time, CPU time, the peak RSS
+# by its end, the number of items it processed (POI, cells, geohashs, ...) and
+# of files it wrote, and so its items per second. The stages that go a country
+# at a time also break these down by country. It's all reported as JSON, so
+# that runs can be compared by other tools.
+# The CPU time and peak RSS include those of the pool's workers, but only once
+# they have been joined - that is, by the end of the stage that used them.
+# One stage can also be run under cProfile, its stats dumped for pstats - with
+# more than one worker, only the parent's share of that stage is profiled.
+
+def cpuSeconds():
+  """ returns the user + system CPU seconds of this process and of its
+    children that have been waited for """
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+def peakRssMB():
+  """ returns the peak RSS of this process, or of the largest of its
+    waited-for children, in MB """
+  maxRss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  # ru_maxrss is in KB on Linux, but in bytes on a Mac
+  if sys.platform == "darwin":
+    maxRss = maxRss / 1024
+  return round(maxRss / 1024.0, 1)
+
+def rate(record):
+  """ adds the itemsPerSecond of a record with its items and wallSeconds """
+  itemsPerSecond = 0
+  if record["wallSeconds"] > 0:
+    itemsPerSecond = round(record["items"] / record["wallSeconds"], 1)
+  record["itemsPerSecond"] = itemsPerSecond
+  return record
+
+
+class Usage:
+  """ The wall and CPU seconds since it was made """
+  def __init__(self):
+    self.wall = time.time()
+    self.cpu = cpuSeconds()
+
+  def since(self):
+    return time.time() - self.wall, cpuSeconds() - self.cpu
+
+
+class Stage:
+  def __init__(self, profiler, name):
+    self.profiler = profiler
+    self.name = name
+    self.countries = dict()
+    self.usage = Usage()
+
+  def addCountry(self, countryCode, wallSeconds, cpuSeconds, items=0, files=0):
+    """ adds to the country's share of the stage - several shards, or
+      partitions, may be of the one country """
+    try:
+      country = self.countries[countryCode]
+    except KeyError:
+      country = dict(wallSeconds=0.0, cpuSeconds=0.0, items=0, files=0)
+      self.countries[countryCode] = country
+    country["wallSeconds"] = country["wallSeconds"] + wallSeconds
+    country["cpuSeconds"] = country["cpuSeconds"] + cpuSeconds
+    country["items"] = country["items"] + items
+    country["files"] = country["files"] + files
+
+  def stop(self, items=0, files=0, **counts):
+    """ ends the stage, having processed the items and written the files - any
+      other counts (bytes, say) are reported along with them """
+    (wallSeconds, cpuSeconds) = self.usage.since()
+    record = dict(name=self.name, wallSeconds=round(wallSeconds, 3),
+        cpuSeconds=round(cpuSeconds, 3), peakRssMB=peakRssMB(), items=items,
+        files=files)
+    record.update(counts)
+    if self.countries:
+      record["countries"] = dict()
+      for countryCode, country in self.countries.iteritems():
+        country["wallSeconds"] = round(country["wallSeconds"], 3)
+        country["cpuSeconds"] = round(country["cpuSeconds"], 3)
+        record["countries"][countryCode] = rate(country)
+    self.profiler.stopped(self, rate(record))
+
+
+class StageProfiler:
+  def __init__(self, cprofileStage=None, cprofileFile=None):
+    self.stages = []
+    # Without a file for its stats, no stage is profiled
+    self.cprofileStage = None
+    if cprofileFile is not None:
+      self.cprofileStage = cprofileStage
+    self.cprofileFile = cprofileFile
+    self.cprofile = None
+    self.usage = Usage()
+
+  def start(self, name):
+    """ returns a new Stage, to be stopped when it's done """
+    stage = Stage(self, name)
+    if name == self.cprofileStage:
+      # A stage that's run more than once is profiled all together
+      if self.cprofile is None:
+        import cProfile
+        self.cprofile = cProfile.Profile()
+      self.cprofile.enable()
+    return stage
+
+  def stopped(self, stage, record):
+    if stage.name == self.cprofileStage:
+      self.cprofile.disable()
+      self.cprofile.dump_stats(self.cprofileFile)
+    self.stages.append(record)
+
+  def report(self, **run):
+    """ returns the report of the stages so far, with the run's details """
+    (wallSeconds, cpuSeconds) = self.usage.since()
+    return dict(run=run, wallSeconds=round(wallSeconds, 3),
+        cpuSeconds=round(cpuSeconds, 3), peakRssMB=peakRssMB(),
+        stages=self.stages)
+
+  def save(self, filename, **run):
+    f = open(filename, "w")
+    json.dump(self.report(**run), f, indent=2, sort_keys=True)
+    f.write("\n")
+    f.close()
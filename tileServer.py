@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import BaseHTTPServer
+import SocketServer
+import collections
+import hashlib
+import threading
+import urllib
+
+# A small HTTP server of KML documents that are rendered as they are asked for,
+# rather than all written out up front - clients only ever open a few regions
+# of the hierarchy. What it serves comes from a render function of the URL's
+# path, which returns the (document, content type) or None when there is no
+# such document. The most recently used documents are kept in an LRU cache,
+# and each has an ETag (the MD5 of the document) so that the requests of
+# onRegion refreshes - with If-None-Match - are answered with a bodiless 304.
+
+CONTENT_TYPES = {
+  "kml": "application/vnd.google-earth.kml+xml",
+  "kmz": "application/vnd.google-earth.kmz",
+}
+
+class DocumentCache:
+  """ An LRU cache of up to maxEntries rendered (document, content type,
+    etag)s, by path """
+  def __init__(self, render, maxEntries=10000):
+    self.render = render
+    self.maxEntries = maxEntries
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, path):
+    with self.lock:
+      try:
+        entry = self.entries.pop(path)
+        self.entries[path] = entry
+        self.hits = self.hits + 1
+        return entry
+      except KeyError:
+        self.misses = self.misses + 1
+    # Rendered outside of the lock, so that one slow document doesn't hold up
+    # the rest - the odd document may be rendered twice
+    rendered = self.render(path)
+    if rendered is None:
+      return None
+    (document, contentType) = rendered
+    entry = (document, contentType, '"%s"' % hashlib.md5(document).hexdigest())
+    with self.lock:
+      self.entries[path] = entry
+      while len(self.entries) > self.maxEntries:
+        self.entries.popitem(last=False)
+    return entry
+
+  def stats(self):
+    return "cache: %d hits, %d misses, %d entries" % \
+        (self.hits, self.misses, len(self.entries))
+
+
+class TileRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    self.respond(True)
+
+  def do_HEAD(self):
+    self.respond(False)
+
+  def respond(self, withBody):
+    path = urllib.unquote(self.path.split("?", 1)[0])
+    entry = self.server.cache.get(path)
+    if entry is None:
+      self.send_error(404)
+      return
+    (document, contentType, etag) = entry
+    ifNoneMatch = [tag.strip() for tag in \
+        self.headers.get("If-None-Match", "").split(",")]
+    if etag in ifNoneMatch or "*" in ifNoneMatch:
+      self.send_response(304)
+      self.send_header("ETag", etag)
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header("Content-Type", contentType)
+    self.send_header("Content-Length", str(len(document)))
+    self.send_header("ETag", etag)
+    # Cached, but checked again with the server (cheaply) every time
+    self.send_header("Cache-Control", "no-cache")
+    self.end_headers()
+    if withBody:
+      self.wfile.write(document)
+
+
+class TileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, render, cacheSize=10000):
+    BaseHTTPServer.HTTPServer.__init__(self, address, TileRequestHandler)
+    self.cache = DocumentCache(render, cacheSize)
+
+
+def serve(render, port, host="localhost", cacheSize=10000):
+  """ serves the documents of render on host:port until interrupted """
+  server = TileServer((host, port), render, cacheSize)
+  print "Serving on http://%s:%d/" % (host, port)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.server_close()
+  print server.cache.stats()